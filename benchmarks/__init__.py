@@ -0,0 +1,6 @@
+"""Benchmarks of the ORM's hot paths.
+
+`python -m benchmarks` runs the suite of `benchmarks.cases` against the
+models of `examples/complete.py` and prints the results as JSON, so runs
+on different commits can be compared.
+"""
@@ -0,0 +1,151 @@
+"""Runs the benchmark suite and prints the results as JSON.
+
+Usage:
+    python -m benchmarks [--sizes 1000,10000,100000] [--repeat 3]
+        [--cases get_cold,find_cold] [--db PATH] [--output FILE]
+        [--compare FILE]
+
+Sizes are numbers of users in the database, up to 1000000. Each case
+runs `repeat` times per size and the fastest run is kept. Progress goes
+to stderr, and with `--compare`, the change against the results of an
+earlier run, for example on another commit.
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+from datetime import datetime, timezone
+from time import perf_counter
+
+from benchmarks.cases import CASES
+from benchmarks.models import fixture
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(",")]
+    names = args.cases.split(",") if args.cases else list(CASES)
+    unknown = set(names) - set(CASES)
+    if unknown:
+        raise SystemExit(f"Unknown cases: {', '.join(sorted(unknown))}")
+    # Cases writing to an empty database first, then the ones reading
+    # the rows, which are only inserted once per size
+    cases = sorted((CASES[name] for name in names), key=lambda c: c.populated)
+
+    if args.db != ":memory:" and os.path.exists(args.db):
+        os.remove(args.db)
+    models = fixture(args.db)
+    results = []
+    for size in sizes:
+        for case in cases:
+            result = _run(models, case, size, args.repeat)
+            results.append(result)
+            print(_describe(result), file=sys.stderr)
+
+    report = {
+        "environment": _environment(),
+        "settings": {"sizes": sizes, "repeat": args.repeat, "db": args.db},
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            _compare(json.load(f)["results"], results)
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks", description="Runs the benchmarks."
+    )
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--cases", help=f"Comma separated, out of {', '.join(CASES)}"
+    )
+    parser.add_argument("--db", default=":memory:", help="SQLite file")
+    parser.add_argument("--output", help="File for the JSON results")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    return parser
+
+
+def _run(models, case, size, repeat) -> dict:
+    best = None
+    measurements = {}
+    for _ in range(repeat):
+        if case.populated:
+            models.populate(size)
+        else:
+            models.reset()
+        n, func = case.setup(models, size)
+        start = perf_counter()
+        measured = func()
+        elapsed = perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+            measurements = measured or {}
+    return {
+        "case": case.name,
+        "size": size,
+        "operations": n,
+        "seconds": best,
+        "per_second": n / best if best else None,
+        **measurements,
+    }
+
+
+def _describe(result) -> str:
+    text = (
+        f"{result['case']:<20} {result['size']:>8} "
+        f"{result['per_second']:>12.0f} per second"
+    )
+    if "bytes_per_instance" in result:
+        text += f" {result['bytes_per_instance']:>8.0f} bytes per instance"
+    return text
+
+
+def _environment() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+    }
+
+
+def _compare(earlier, results):
+    """Prints the change of each result against an earlier one."""
+    earlier = {(result["case"], result["size"]): result for result in earlier}
+    print("change against earlier run", file=sys.stderr)
+    for result in results:
+        before = earlier.get((result["case"], result["size"]))
+        if before is None or not before["per_second"]:
+            continue
+        change = result["per_second"] / before["per_second"] - 1
+        text = f"{result['case']:<20} {result['size']:>8} {change:>+8.1%}"
+        if "bytes_per_instance" in result and "bytes_per_instance" in before:
+            memory = (
+                result["bytes_per_instance"] / before["bytes_per_instance"] - 1
+            )
+            text += f" {memory:>+8.1%} memory"
+        print(text, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""The cases of the benchmark suite.
+
+A case gets the fixture and the number of users in the database, does
+its setup and returns how many operations it runs and the function
+running them, which is what gets timed. The function may return further
+measurements, like the memory used. Cases reading rows run on a
+populated database, the others on an empty one.
+
+Operations which each need a statement or transaction of their own run
+at most MAX_OPERATIONS times, so large sizes don't take hours.
+"""
+import random
+import tracemalloc
+from dataclasses import dataclass
+from typing import Callable
+
+from dcorm import Session
+
+from benchmarks.models import CLASS_SIZE, RANKS, Rank
+
+
+MAX_OPERATIONS = 10_000
+
+
+@dataclass(frozen=True)
+class Case:
+    name: str
+    setup: Callable
+    populated: bool  # Whether it reads the rows of a populated database
+
+
+CASES = {}
+
+
+def case(name, populated=False):
+    def add(setup):
+        CASES[name] = Case(name, setup, populated)
+        return setup
+    return add
+
+
+def _sample(fixture, size):
+    """Ids of random users in the database, the same ones every run."""
+    n = min(size, MAX_OPERATIONS)
+    return random.Random(size).sample(fixture.ids, n)
+
+
+@case("construct")
+def construct(fixture, size):
+    User = fixture.User
+
+    def run():
+        for i in range(size):
+            User(name="Bob", rank=Rank.FIRST)
+    return size, run
+
+
+@case("field_set")
+def field_set(fixture, size):
+    """Assigning two fields of saved users, which tracks the changes."""
+    users = fixture.users(size)
+    with Session() as session:
+        session.add_all(users)
+
+    def run():
+        for user in users:
+            user.name = "Bill"
+            user.rank = Rank.THIRD
+    return size, run
+
+
+@case("save_single")
+def save_single(fixture, size):
+    """Saving users one at a time, in a transaction each."""
+    users = fixture.users(min(size, MAX_OPERATIONS))
+
+    def run():
+        for user in users:
+            user.save()
+    return len(users), run
+
+
+@case("save_graph")
+def save_graph(fixture, size):
+    """Saving classes in a session, which finds their users through the
+    collections."""
+    classes = fixture.classes(size)
+
+    def run():
+        with Session() as session:
+            session.add_all(classes)
+    return size, run
+
+
+@case("get_cold", populated=True)
+def get_cold(fixture, size):
+    """Getting users by id, loading each from the database."""
+    User = fixture.User
+    ids = _sample(fixture, size)
+
+    def run():
+        for id_ in ids:
+            User.get(id=id_)
+    return len(ids), run
+
+
+@case("find_single", populated=True)
+def find_single(fixture, size):
+    """Finding classes by name one at a time, in a table small enough
+    that preparing the statement weighs more than scanning it."""
+    Class = fixture.Class
+    classes = -(-size // CLASS_SIZE)
+    names = [f"class {i % classes}" for i in range(min(size, MAX_OPERATIONS))]
+
+    def run():
+        for name in names:
+            list(Class.find(name=name))
+    return len(names), run
+
+
+@case("get_warm", populated=True)
+def get_warm(fixture, size):
+    """Getting users by id from the cache."""
+    User = fixture.User
+    ids = _sample(fixture, size)
+    for id_ in ids:
+        User.get(id=id_)
+
+    def run():
+        for id_ in ids:
+            User.get(id=id_)
+    return len(ids), run
+
+
+@case("find_cold", populated=True)
+def find_cold(fixture, size):
+    """Iterating over all users of a rank, loading them."""
+    query_set = fixture.User.find(rank=RANKS[0])
+    n = query_set.count()
+
+    def run():
+        for _ in query_set:
+            pass
+    return n, run
+
+
+@case("find_warm", populated=True)
+def find_warm(fixture, size):
+    """Iterating over all users of a rank, which are cached already."""
+    query_set = fixture.User.find(rank=RANKS[0])
+    cached = list(query_set)
+
+    def run():
+        for _ in query_set:
+            pass
+    return len(cached), run
+
+
+@case("collection_lazy", populated=True)
+def collection_lazy(fixture, size):
+    """Loading the users of each class on first access."""
+    classes = list(fixture.Class.all())
+
+    def run():
+        for class_ in classes:
+            len(class_.users)
+    return size, run
+
+
+@case("collection_prefetch", populated=True)
+def collection_prefetch(fixture, size):
+    """Loading all classes with their users in bulk."""
+    query_set = fixture.Class.all().prefetch("users")
+
+    def run():
+        for _ in query_set:
+            pass
+    return size, run
+
+
+@case("memory", populated=True)
+def memory(fixture, size):
+    """Memory per user loaded into the cache, including its values."""
+    query_set = fixture.User.all()
+    return size, lambda: _memory(query_set)
+
+
+@case("memory_compact", populated=True)
+def memory_compact(fixture, size):
+    """Like memory, with compact instances keeping their values in slots
+    instead of a dict."""
+    CompactUser = fixture.CompactUser
+    CompactUser.all().delete()
+    with Session() as session:
+        session.add_all(
+            CompactUser(name=f"user {i}", rank=RANKS[i % len(RANKS)])
+            for i in range(size)
+        )
+    CompactUser._cache.clear()
+    query_set = CompactUser.all()
+    return size, lambda: _memory(query_set)
+
+
+def _memory(query_set) -> dict:
+    """Memory per instance loaded by the query set."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        instances = list(query_set)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return {"bytes_per_instance": (after - before) / len(instances)}
@@ -0,0 +1,110 @@
+"""The models of examples/complete.py, a compact copy of User, and the
+rows the cases run on."""
+from dataclasses import dataclass, field
+from enum import Enum
+from uuid import UUID, uuid4
+
+from dcorm import Collection, Field, Model, Session, register
+from dcorm.mappers.sqlite import SQLite3
+
+
+# Users per class
+CLASS_SIZE = 100
+
+
+class Rank(Enum):
+    FIRST = "first"
+    SECOND = "second"
+    THIRD = "third"
+
+
+RANKS = list(Rank)
+
+
+@dataclass
+class Fixture:
+    """Registered models, which can be filled with `size` users."""
+    db: SQLite3
+    User: type
+    Class: type
+    # Like User, with compact instances, see register
+    CompactUser: type
+    size: int = 0
+    # Of the users in the database
+    ids: list = field(default_factory=list)
+
+    def clear_caches(self):
+        self.User._cache.clear()
+        self.Class._cache.clear()
+        self.CompactUser._cache.clear()
+
+    def reset(self):
+        """Empties the database and caches."""
+        self.User.all().delete()
+        self.Class.all().delete()
+        self.CompactUser.all().delete()
+        self.clear_caches()
+        self.size = 0
+        self.ids = []
+
+    def users(self, n) -> list:
+        """New users, which aren't saved yet."""
+        return [
+            self.User(name=f"user {i}", rank=RANKS[i % len(RANKS)])
+            for i in range(n)
+        ]
+
+    def classes(self, n) -> list:
+        """New classes of users, with CLASS_SIZE users each, but the last
+        one, and n users in total, which aren't saved yet."""
+        users = self.users(n)
+        classes = []
+        for start in range(0, n, CLASS_SIZE):
+            class_ = self.Class(name=f"class {start // CLASS_SIZE}")
+            for user in users[start:start + CLASS_SIZE]:
+                class_.users.append(user)
+            classes.append(class_)
+        return classes
+
+    def populate(self, size):
+        """Fills the database with size users in classes, unless it has
+        them already, and empties the caches."""
+        if self.size != size:
+            self.reset()
+            classes = self.classes(size)
+            with Session() as session:
+                session.add_all(classes)
+            self.size = size
+            self.ids = [
+                user.id
+                for class_ in classes for user in class_.users.relationships
+            ]
+        self.clear_caches()
+
+
+def fixture(db_path=":memory:") -> Fixture:
+    """Registers the models on a new database, only once per process as
+    models are registered by name."""
+    db = SQLite3(db_path)
+
+    @register(db)
+    class User(Model):
+        id: UUID = Field(default_factory=uuid4)
+        name: str = Field()
+        class_: 'Class' = Field(null=True)
+        rank: Rank = Field()
+
+    @register(db)
+    class Class(Model):
+        id: UUID = Field(default_factory=uuid4)
+        users: list[User] = Collection(backref="class_")
+        name: str = Field()
+
+    @register(db, slots=True)
+    class CompactUser(Model):
+        id: UUID = Field(default_factory=uuid4)
+        name: str = Field()
+        class_: Class = Field(null=True)
+        rank: Rank = Field()
+
+    return Fixture(db, User, Class, CompactUser)
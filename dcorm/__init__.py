@@ -1,2 +1,3 @@
 from .fields import Field, Collection
 from .model import Model, register
+from .session import Session
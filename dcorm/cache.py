@@ -0,0 +1,389 @@
+from collections import OrderedDict, namedtuple
+from dataclasses import dataclass
+from threading import RLock
+from time import monotonic
+from typing import Any, Iterator
+from weakref import KeyedRef
+
+
+CacheInfo = namedtuple("CacheInfo", "hits misses evictions currsize")
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+class IdentityMap:
+    """Holds at most one instance per primary key of a model.
+
+    This base version keeps every instance until it is discarded. The
+    subclasses release instances again, but never ones that are pinned
+    or still have unsaved changes.
+
+    `lock` guards changes from several threads. Query sets also hold it
+    while hydrating a row, so a row loaded by two threads at once still
+    becomes a single instance.
+    """
+
+    def __init__(self):
+        self.lock = RLock()
+        self._instances = {}
+        self._pinned = {}
+        # Instances with unsaved changes, by object id as they may not
+        # have a primary key yet
+        self._dirty = {}
+        self.stats = CacheStats()
+
+    def __contains__(self, id_) -> bool:
+        return self._lookup(id_) is not None
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(list(self._instances.values()))
+
+    def __len__(self) -> int:
+        return len(self._instances)
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(
+            self.stats.hits, self.stats.misses, self.stats.evictions,
+            len(self)
+        )
+
+    def get(self, id_, default=None):
+        """Looks up an instance and records a hit or miss."""
+        with self.lock:
+            instance = self._lookup(id_)
+        if instance is None:
+            self.stats.misses += 1
+            return default
+        self.stats.hits += 1
+        return instance
+
+    def peek(self, id_, default=None):
+        """Looks up an instance without recording statistics."""
+        with self.lock:
+            instance = self._lookup(id_)
+        return default if instance is None else instance
+
+    def peek_all(self, ids) -> list:
+        """Like peek for many ids, with None for the ones not cached."""
+        with self.lock:
+            lookup = self._lookup
+            return [lookup(id_) for id_ in ids]
+
+    def add(self, instance):
+        with self.lock:
+            self._instances[instance.id] = instance
+
+    def discard(self, instance):
+        with self.lock:
+            if self._instances.get(instance.id) is instance:
+                del self._instances[instance.id]
+            self._pinned.pop(instance.id, None)
+            self._dirty.pop(id(instance), None)
+
+    def clear(self):
+        with self.lock:
+            self._instances.clear()
+            self._pinned.clear()
+            self._dirty.clear()
+
+    def expire(self) -> list:
+        """Drops every instance which isn't pinned and has no unsaved
+        changes. Returns the pinned ones without unsaved changes, which
+        are kept."""
+        kept = []
+        with self.lock:
+            for instance in self:
+                if self._evictable(instance):
+                    self.discard(instance)
+                elif not instance._has_unsaved_changes:
+                    kept.append(instance)
+        return kept
+
+    def pin(self, instance):
+        """Keeps the instance cached until it is unpinned."""
+        with self.lock:
+            self._pinned[instance.id] = instance
+            self.add(instance)
+
+    def unpin(self, instance):
+        self._pinned.pop(instance.id, None)
+
+    def mark_dirty(self, instance):
+        """Called when an instance gets unsaved changes."""
+        self._dirty[id(instance)] = instance
+
+    def mark_clean(self, instance):
+        """Called when an instance is in sync with the database again."""
+        dirty = self._dirty
+        dirty.pop(id(instance), None)
+        if not dirty:
+            # Dicts don't shrink, so iterating would still take as long
+            # as it was large, like after saving many new instances
+            self._dirty = {}
+
+    def dirty(self) -> list:
+        """Instances with unsaved changes."""
+        if not self._dirty:
+            return []
+        return list(self._dirty.values())
+
+    def has_dirty(self) -> bool:
+        return bool(self._dirty)
+
+    def _lookup(self, id_):
+        return self._instances.get(id_)
+
+    def _evictable(self, instance) -> bool:
+        return (
+            not instance._has_unsaved_changes
+            and instance.id not in self._pinned
+        )
+
+    def _evict(self, id_):
+        del self._instances[id_]
+        self.stats.evictions += 1
+
+
+class WeakIdentityMap(IdentityMap):
+    """Only keeps instances that are still referenced somewhere else.
+
+    Instances with unsaved changes are referenced strongly until they
+    are saved, so changes are never lost to garbage collection.
+    """
+
+    def __iter__(self) -> Iterator[Any]:
+        instances = (ref() for ref in list(self._instances.values()))
+        return iter([
+            instance for instance in instances if instance is not None
+        ])
+
+    def add(self, instance):
+        with self.lock:
+            self._instances[instance.id] = KeyedRef(
+                instance, self._collected, instance.id
+            )
+
+    def discard(self, instance):
+        with self.lock:
+            ref = self._instances.get(instance.id)
+            if ref is not None and ref() is instance:
+                del self._instances[instance.id]
+            self._pinned.pop(instance.id, None)
+            self._dirty.pop(id(instance), None)
+
+    def _lookup(self, id_):
+        ref = self._instances.get(id_)
+        return None if ref is None else ref()
+
+    def _collected(self, ref):
+        with self.lock:
+            if self._instances.get(ref.key) is ref:
+                self._evict(ref.key)
+
+
+class LRUIdentityMap(IdentityMap):
+    """Keeps at most `max_size` instances, dropping the least recently
+    used ones first."""
+
+    def __init__(self, max_size: int):
+        super().__init__()
+        self.max_size = max_size
+        self._instances = OrderedDict()
+        # Whether the last shrink found nothing to evict, until an
+        # instance may have become evictable
+        self._stuck = False
+
+    def add(self, instance):
+        with self.lock:
+            self._instances[instance.id] = instance
+            self._instances.move_to_end(instance.id)
+            if self._stuck and self._evictable(instance):
+                self._stuck = False
+            if len(self._instances) > self.max_size:
+                self._shrink()
+
+    def unpin(self, instance):
+        super().unpin(instance)
+        self._stuck = False
+
+    def mark_clean(self, instance):
+        super().mark_clean(instance)
+        self._stuck = False
+
+    def _lookup(self, id_):
+        instance = self._instances.get(id_)
+        if instance is not None:
+            self._instances.move_to_end(id_)
+        return instance
+
+    def _shrink(self):
+        if self._stuck:
+            return
+        instances = self._instances
+        excess = len(instances) - self.max_size
+        # Each instance is looked at once at most, from the least recently
+        # used on. The ones which can't be evicted are moved to the end,
+        # out of the way of the next shrink.
+        for _ in range(len(instances)):
+            if excess <= 0:
+                return
+            id_, instance = next(iter(instances.items()))
+            if self._evictable(instance):
+                self._evict(id_)
+                excess -= 1
+            else:
+                instances.move_to_end(id_)
+        self._stuck = excess > 0
+
+
+class TTLIdentityMap(IdentityMap):
+    """Drops instances `ttl` seconds after they were cached, so they are
+    loaded from the database again."""
+
+    def __init__(self, ttl: float):
+        super().__init__()
+        self.ttl = ttl
+        self._expires = {}
+        self._next_sweep = monotonic() + ttl
+
+    def __iter__(self) -> Iterator[Any]:
+        self._sweep()
+        return super().__iter__()
+
+    def add(self, instance):
+        now = monotonic()
+        with self.lock:
+            self._instances[instance.id] = instance
+            self._expires[instance.id] = now + self.ttl
+            if now >= self._next_sweep:
+                self._sweep()
+
+    def discard(self, instance):
+        with self.lock:
+            super().discard(instance)
+            if instance.id not in self._instances:
+                self._expires.pop(instance.id, None)
+
+    def clear(self):
+        with self.lock:
+            super().clear()
+            self._expires.clear()
+
+    def _lookup(self, id_):
+        instance = self._instances.get(id_)
+        if instance is None:
+            return None
+        if self._expires[id_] <= monotonic() and self._evictable(instance):
+            self._evict(id_)
+            return None
+        return instance
+
+    def _evict(self, id_):
+        super()._evict(id_)
+        del self._expires[id_]
+
+    def _sweep(self):
+        now = monotonic()
+        with self.lock:
+            self._next_sweep = now + self.ttl
+            for id_, expires in list(self._expires.items()):
+                if expires <= now and self._evictable(self._instances[id_]):
+                    self._evict(id_)
+
+
+@dataclass
+class QueryCacheStats(CacheStats):
+    invalidations: int = 0
+
+
+class QueryCache:
+    """Ids of the instances found by queries of one model, so repeating a
+    query only looks them up in the identity map.
+
+    Keeps at most `max_size` results, dropping the least recently used
+    ones first, and none with more than `max_ids` ids. Writes through the
+    ORM drop the results depending on the columns they change, or all of
+    them for inserts and deletes. Writes by other programs are only seen
+    with the `check_interval` of the mapper, or after `Model.expire`.
+    """
+
+    def __init__(self, max_size: int = 1000, max_ids: int = 10_000):
+        self.max_size = max_size
+        self.max_ids = max_ids
+        self.lock = RLock()
+        # Ids and column names by the key of the query
+        self._results = OrderedDict()
+        # Keys of the results by the column names they depend on
+        self._by_name = {}
+        # Changes on every invalidation, results read before one aren't
+        # kept, as they may miss the write
+        self.generation = 0
+        self.stats = QueryCacheStats()
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(
+            self.stats.hits, self.stats.misses, self.stats.evictions,
+            len(self)
+        )
+
+    def get(self, key):
+        """Ids found by the query, or None, recording a hit or miss."""
+        with self.lock:
+            result = self._results.get(key)
+            if result is None:
+                self.stats.misses += 1
+                return None
+            self._results.move_to_end(key)
+            self.stats.hits += 1
+            return result[0]
+
+    def put(self, key, ids, names, generation):
+        """Keeps the ids found by a query depending on the column names,
+        unless there were writes since `generation` was read."""
+        ids = tuple(ids)
+        if len(ids) > self.max_ids:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            self._drop(key)
+            self._results[key] = ids, names
+            for name in names:
+                self._by_name.setdefault(name, set()).add(key)
+            while len(self._results) > self.max_size:
+                self._drop(next(iter(self._results)))
+                self.stats.evictions += 1
+
+    def invalidate(self, names=None):
+        """Drops the results depending on the column names, or all."""
+        with self.lock:
+            self.generation += 1
+            self.stats.invalidations += 1
+            if names is None:
+                self._results.clear()
+                self._by_name.clear()
+                return
+            for name in names:
+                for key in list(self._by_name.get(name, ())):
+                    self._drop(key)
+
+    def clear(self):
+        self.invalidate()
+
+    def _drop(self, key):
+        result = self._results.pop(key, None)
+        if result is None:
+            return
+        for name in result[1]:
+            keys = self._by_name[name]
+            keys.discard(key)
+            if not keys:
+                del self._by_name[name]
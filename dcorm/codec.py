@@ -0,0 +1,120 @@
+from typing import Any, Callable, Mapping, Optional
+
+from dcorm.storage import NO_CHANGES
+
+
+Converter = Optional[Callable[[Any], Any]]
+
+
+class Codec:
+    """Turns rows of one model into instances and back.
+
+    The functions are generated as Python source for the fields of the
+    model, the way dataclasses generates __init__, with a converter per
+    column which is skipped for None values or when it is None itself.
+    Rows come from the database and are trusted, so decoding sets the
+    field values directly instead of going through the descriptors.
+    """
+
+    def __init__(
+        self, model_cls, decoders: Mapping[str, Converter],
+        encoders: Mapping[str, Converter]
+    ):
+        self.model_cls = model_cls
+        self.columns = tuple(model_cls._meta.fields)
+        # Whether field values are kept in slots, see register
+        self.compact = model_cls._meta.values is not dict
+        self._decoders = decoders
+        self._encoders = encoders
+        self.decode = self._decoder()
+        self._encoder_cache = {}
+
+    def encoder(self, columns: tuple) -> Callable[[Any], tuple]:
+        """Function returning the values of the columns of an instance
+        in the form the database stores them."""
+        encode = self._encoder_cache.get(columns)
+        if encode is None:
+            encode = self._encoder_cache[columns] = self._encoder(columns)
+        return encode
+
+    def encode_value(self, name: str, value):
+        """A value of a field in the form the database stores it."""
+        encode = self._encoders[name]
+        if value is None or encode is None:
+            return value
+        return encode(value)
+
+    def _decoder(self) -> Callable[[tuple, Any], Any]:
+        """Function creating an instance loaded from the database from a
+        row with the values of all columns in order and its converted id,
+        which is known already to look it up in the identity map."""
+        namespace = {
+            "cls": self.model_cls, "new": object.__new__,
+            "post_init": self.model_cls.__post_init__,
+            "values_cls": self.model_cls._meta.values,
+            "NO_CHANGES": NO_CHANGES,
+        }
+        values = []
+        for index, name in enumerate(self.columns):
+            if name == "id":
+                value = "id_"
+            else:
+                value = _converted(
+                    f"row[{index}]", name, self._decoders[name], namespace
+                )
+            values.append((name, value))
+        if self.compact:
+            lines = [
+                "    values = new(values_cls)",
+                *(f"    values.f_{name} = {value}" for name, value in values),
+                "    instance._descriptor_values = values",
+                "    instance._has_unsaved_changes = False",
+                "    instance.savable = True",
+            ]
+        else:
+            items = ", ".join(f"{name!r}: {value}" for name, value in values)
+            lines = [f"    instance._descriptor_values = {{{items}}}"]
+        source = "\n".join((
+            "def decode(row, id_):",
+            "    instance = new(cls)",
+            *lines,
+            "    instance._changes = NO_CHANGES",
+            "    post_init(instance)",
+            "    instance._in_db = True",
+            "    if instance._has_unsaved_changes:",
+            "        instance._mark_clean()",
+            "    return instance",
+        ))
+        return _compile(source, "decode", namespace, self.model_cls)
+
+    def _encoder(self, columns) -> Callable[[Any], tuple]:
+        namespace = {}
+        if self.compact:
+            get = "getattr(values, 'f_{}', None)".format
+        else:
+            get = "get({!r})".format
+        values = [
+            _converted(get(name), name, self._encoders[name], namespace) + ","
+            for name in columns
+        ]
+        source = "\n".join((
+            "def encode(instance):",
+            "    values = instance._descriptor_values",
+            "    get = values.get",
+            f"    return ({' '.join(values)})",
+        ))
+        return _compile(source, "encode", namespace, self.model_cls)
+
+
+def _converted(value, name, converter, namespace) -> str:
+    """Expression converting value unless it is None."""
+    if converter is None:
+        return value
+    namespace[f"convert_{name}"] = converter
+    return f"None if (value := {value}) is None else convert_{name}(value)"
+
+
+def _compile(source, name, namespace, model_cls):
+    code = compile(source, f"<dcorm {model_cls.__name__}.{name}>", "exec")
+    exec(code, namespace)
+    return namespace[name]
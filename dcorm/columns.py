@@ -0,0 +1,117 @@
+"""Query results as one sequence per field, see `QuerySet.columns`."""
+from array import array
+from datetime import datetime
+from itertools import chain, islice
+from typing import Iterator
+
+try:
+    import numpy
+except ImportError:  # Optional, arrays from the standard library are used
+    numpy = None
+
+
+# Array type code and NumPy dtype of fields stored as plain numbers
+_NUMBERS = {
+    bool: ("b", "bool"),
+    int: ("q", "int64"),
+    float: ("d", "float64"),
+}
+
+
+def has_numpy() -> bool:
+    return numpy is not None
+
+
+def column_chunks(model_cls, rows, fields, size, use_numpy) -> Iterator[dict]:
+    """Dicts of a sequence per field for every `size` rows, which hold
+    the values of the fields in the form the mapper stores them.
+
+    Numbers become arrays, or NumPy arrays, and other values lists, or
+    NumPy arrays of objects, converted like the fields convert them. With
+    NumPy, datetimes become datetime64 values in UTC. Columns of numbers
+    with NULL values hold None, so they are lists or arrays of objects.
+    """
+    if use_numpy and numpy is None:
+        raise ValueError("NumPy is not installed")
+    kinds = [_kind(model_cls, name, use_numpy) for name in fields]
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield {
+            name: _column(values, kind, use_numpy)
+            for name, kind, values in zip(fields, kinds, zip(*chunk))
+        }
+
+
+def concatenate(chunks, model_cls, fields, use_numpy) -> dict:
+    """The chunks of `column_chunks` joined to one sequence per field."""
+    parts = {name: [] for name in fields}
+    for chunk in chunks:
+        for name, values in chunk.items():
+            parts[name].append(values)
+    return {
+        name: _joined(parts[name], model_cls, name, use_numpy)
+        for name in fields
+    }
+
+
+def _kind(model_cls, name, use_numpy) -> tuple:
+    """Array type code and NumPy dtype of a field if its values are
+    numbers, and the converter of values kept as objects."""
+    meta = model_cls._meta
+    target = meta.relations.get(name)
+    if target is None:
+        hint = meta.type_hints[name]
+    else:
+        # The column holds ids
+        hint = target._meta.type_hints["id"]
+    typecode, dtype = _NUMBERS.get(hint, (None, None))
+    if use_numpy and hint is datetime:
+        # Timestamps, converted all at once
+        typecode, dtype = "d", "datetime64[us]"
+    # SQLite returns these as they are
+    convert = None if hint in (str, bytes) else meta.converters[name]
+    return typecode, dtype, convert
+
+
+def _column(values, kind, use_numpy):
+    typecode, dtype, convert = kind
+    if typecode is not None:
+        try:
+            numbers = array(typecode, values)
+        except TypeError:  # NULL values, kept as objects
+            pass
+        else:
+            if not use_numpy:
+                return numbers
+            if not numbers:
+                return numpy.empty(0, dtype)
+            if dtype.startswith("datetime64"):
+                micros = numpy.rint(numpy.frombuffer(numbers, "float64") * 1e6)
+                return micros.astype("int64").astype(dtype)
+            return numpy.frombuffer(numbers, dtype)
+    if convert is None:
+        values = list(values)
+    else:
+        values = list(map(convert, values))
+    if not use_numpy:
+        return values
+    objects = numpy.empty(len(values), dtype=object)
+    objects[:] = values
+    return objects
+
+
+def _joined(parts, model_cls, name, use_numpy):
+    if not parts:
+        # No rows, still with the type there would be
+        return _column((), _kind(model_cls, name, use_numpy), use_numpy)
+    if len(parts) == 1:
+        return parts[0]
+    if use_numpy:
+        return numpy.concatenate(parts)
+    if all(type(part) is type(parts[0]) for part in parts):
+        joined = parts[0]
+        for part in parts[1:]:
+            joined.extend(part)
+        return joined
+    # Some parts of numbers had NULL values
+    return list(chain.from_iterable(parts))
@@ -0,0 +1,373 @@
+"""Conditions on model fields, usable in `Model.find` and `Model.get`.
+
+Once a model is registered, its fields accessed on the class are columns
+which build conditions with the usual operators:
+
+    User.find((User.name.startswith("B") | User.rank.is_(None)) & ~(User.age < 18))
+
+Mappers translate conditions into their query language, and the same
+conditions are evaluated in Python against instances in memory. Values
+are compared the way the mapper stores them, so both agree.
+"""
+from dataclasses import dataclass
+from typing import Any, NamedTuple
+
+
+class Expression:
+    """A condition instances either match or not."""
+
+    def __and__(self, other):
+        return And((self, other))
+
+    def __or__(self, other):
+        return Or((self, other))
+
+    def __invert__(self):
+        return Not(self)
+
+    def shape(self) -> tuple:
+        """Hashable structure of the condition without its values."""
+        raise NotImplementedError
+
+    def key(self) -> tuple:
+        """Structure of the condition with its values, in which the terms
+        of And and Or have no order. Building or hashing it raises TypeError
+        if the values aren't hashable."""
+        raise NotImplementedError
+
+    def names(self) -> frozenset:
+        """Names of the fields the condition depends on."""
+        raise NotImplementedError
+
+    def evaluate(self, instance):
+        """Whether the values of the instance in memory match, or None if
+        that is unknown because of NULL values, like in SQL."""
+        raise NotImplementedError
+
+    def matches(self, instance) -> bool:
+        return self.evaluate(instance) is True
+
+
+@dataclass(frozen=True, eq=False)
+class Column:
+    """A field of a registered model, used to build conditions."""
+    model: type
+    name: str
+
+    def __repr__(self):
+        return f"{self.model.__name__}.{self.name}"
+
+    def __hash__(self):
+        return hash((self.model, self.name))
+
+    def __eq__(self, other):
+        if other is None:
+            return IsNull(self)
+        return Comparison(self, "=", self._store(other))
+
+    def __ne__(self, other):
+        if other is None:
+            return IsNull(self, negated=True)
+        return Comparison(self, "!=", self._store(other))
+
+    def __lt__(self, other):
+        return Comparison(self, "<", self._store(other))
+
+    def __le__(self, other):
+        return Comparison(self, "<=", self._store(other))
+
+    def __gt__(self, other):
+        return Comparison(self, ">", self._store(other))
+
+    def __ge__(self, other):
+        return Comparison(self, ">=", self._store(other))
+
+    def is_(self, other):
+        return self == other
+
+    def is_not(self, other):
+        return self != other
+
+    def in_(self, values):
+        return In(self, tuple(self._store(value) for value in values))
+
+    def not_in(self, values):
+        return ~self.in_(values)
+
+    def between(self, low, high):
+        return (self >= low) & (self <= high)
+
+    def startswith(self, prefix: str):
+        return Match(self, "startswith", prefix)
+
+    def endswith(self, suffix: str):
+        return Match(self, "endswith", suffix)
+
+    def contains(self, part: str):
+        return Match(self, "contains", part)
+
+    def asc(self):
+        return Ordering(self.name, False)
+
+    def desc(self):
+        return Ordering(self.name, True)
+
+    def value(self, instance):
+        """Value of this column for an instance, as the mapper stores it."""
+        from dcorm.model import _column_value
+
+        value = _column_value(instance._descriptor_values.get(self.name))
+        return self.model._db._serealize_type(value)
+
+    def _store(self, value):
+        """Converts a value the way the field and mapper would."""
+        from dcorm.model import _column_value
+
+        converter = self.model._meta.converters[self.name]
+        return self.model._db._serealize_type(_column_value(converter(value)))
+
+
+class Ordering(NamedTuple):
+    name: str
+    descending: bool = False
+
+
+@dataclass(frozen=True, eq=False)
+class Comparison(Expression):
+    column: Column
+    operator: str
+    value: Any
+
+    def shape(self):
+        return ("compare", self.column.name, self.operator)
+
+    def key(self):
+        return self.shape() + (self.value,)
+
+    def names(self):
+        return frozenset((self.column.name,))
+
+    def evaluate(self, instance):
+        value = self.column.value(instance)
+        if value is None or self.value is None:
+            return None
+        try:
+            return _OPERATORS[self.operator](value, self.value)
+        except TypeError:
+            return False
+
+
+_OPERATORS = {
+    "=": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+}
+
+
+@dataclass(frozen=True, eq=False)
+class IsNull(Expression):
+    column: Column
+    negated: bool = False
+
+    def shape(self):
+        return ("null", self.column.name, self.negated)
+
+    def key(self):
+        return self.shape()
+
+    def names(self):
+        return frozenset((self.column.name,))
+
+    def evaluate(self, instance):
+        return (self.column.value(instance) is None) is not self.negated
+
+
+@dataclass(frozen=True, eq=False)
+class In(Expression):
+    column: Column
+    values: tuple
+
+    def shape(self):
+        return ("in", self.column.name, len(self.values))
+
+    def key(self):
+        return ("in", self.column.name, self.values)
+
+    def names(self):
+        return frozenset((self.column.name,))
+
+    def evaluate(self, instance):
+        value = self.column.value(instance)
+        if value is None:
+            return None
+        return value in self.values
+
+
+@dataclass(frozen=True, eq=False)
+class Match(Expression):
+    """Text starting with, ending with or containing a part."""
+    column: Column
+    kind: str
+    part: str
+
+    def shape(self):
+        return ("match", self.column.name, self.kind)
+
+    def key(self):
+        return self.shape() + (self.part,)
+
+    def names(self):
+        return frozenset((self.column.name,))
+
+    def evaluate(self, instance):
+        value = self.column.value(instance)
+        if value is None:
+            return None
+        if not isinstance(value, str):
+            return False
+        if self.kind == "startswith":
+            return value.startswith(self.part)
+        if self.kind == "endswith":
+            return value.endswith(self.part)
+        return self.part in value
+
+
+@dataclass(frozen=True, eq=False)
+class And(Expression):
+    terms: tuple
+
+    def __and__(self, other):
+        return And(self.terms + (other,))
+
+    def shape(self):
+        return ("and",) + tuple(term.shape() for term in self.terms)
+
+    def key(self):
+        # In any order, as it doesn't change the result
+        return ("and", frozenset(term.key() for term in self.terms))
+
+    def names(self):
+        return frozenset().union(*(term.names() for term in self.terms))
+
+    def evaluate(self, instance):
+        result = True
+        for term in self.terms:
+            value = term.evaluate(instance)
+            if value is False:
+                return False
+            if value is None:
+                result = None
+        return result
+
+
+@dataclass(frozen=True, eq=False)
+class Or(Expression):
+    terms: tuple
+
+    def __or__(self, other):
+        return Or(self.terms + (other,))
+
+    def shape(self):
+        return ("or",) + tuple(term.shape() for term in self.terms)
+
+    def key(self):
+        # In any order, as it doesn't change the result
+        return ("or", frozenset(term.key() for term in self.terms))
+
+    def names(self):
+        return frozenset().union(*(term.names() for term in self.terms))
+
+    def evaluate(self, instance):
+        result = False
+        for term in self.terms:
+            value = term.evaluate(instance)
+            if value is True:
+                return True
+            if value is None:
+                result = None
+        return result
+
+
+@dataclass(frozen=True, eq=False)
+class Not(Expression):
+    term: Expression
+
+    def shape(self):
+        return ("not", self.term.shape())
+
+    def key(self):
+        return ("not", self.term.key())
+
+    def names(self):
+        return self.term.names()
+
+    def evaluate(self, instance):
+        value = self.term.evaluate(instance)
+        return None if value is None else not value
+
+
+def where(model_cls, query=None, **filters):
+    """Combines a condition and equality filters into one condition."""
+    terms = [] if query is None else [query]
+    for name, value in filters.items():
+        terms.append(column(model_cls, name) == value)
+    if not terms:
+        return None
+    if len(terms) == 1:
+        return terms[0]
+    return And(tuple(terms))
+
+
+def column(model_cls, name) -> Column:
+    if name not in model_cls._meta.fields:
+        raise ValueError(f"{model_cls.__name__} has no field {name!r}")
+    return Column(model_cls, name)
+
+
+def ordering(model_cls, fields) -> tuple:
+    """Orderings for field names, prefixed with "-" for descending order,
+    columns or orderings."""
+    if isinstance(fields, (str, Column, Ordering)):
+        fields = (fields,)
+    orderings = []
+    for field in fields:
+        if isinstance(field, Column):
+            field = field.asc()
+        elif not isinstance(field, Ordering):
+            field = Ordering(field.lstrip("-"), field.startswith("-"))
+        column(model_cls, field.name)
+        orderings.append(field)
+    return tuple(orderings)
+
+
+def sort_key(order_by, value):
+    """Key sorting like the mapper sorts rows, with NULL before any
+    value. `value(item, name)` returns the stored value of a field."""
+
+    def key(item):
+        values = []
+        for name, descending in order_by:
+            field_value = value(item, name)
+            field_value = (field_value is not None, field_value)
+            values.append(
+                _Descending(field_value) if descending else field_value
+            )
+        return tuple(values)
+
+    return key
+
+
+class _Descending:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
@@ -1,6 +1,15 @@
+from copy import copy, deepcopy
 from dataclasses import dataclass, field
-from datetime import datetime
-from typing import Any, Callable, get_type_hints
+from typing import Any, Callable
+
+from dcorm.expressions import Column
+
+
+# How related instances are loaded
+LAZY = "lazy"  # On first access
+EAGER = "eager"  # Together with the instance pointing to them
+NOLOAD = "noload"  # Never, only instances loaded otherwise are used
+LOADING = (LAZY, EAGER, NOLOAD)
 
 
 @dataclass
@@ -9,6 +18,13 @@ class Field:
     default_factory: Callable = None
     null: bool = False
     backref: str = None
+    loading: str = LAZY
+    index: bool = False  # Speeds up finding instances by this field
+    unique: bool = False  # No two instances may have the same value
+
+    def __post_init__(self):
+        if self.loading not in LOADING:
+            raise ValueError(f"loading needs to be one of {LOADING}")
 
     def __set_name__(self, owner, name):
         self._owner = owner
@@ -17,9 +33,7 @@ class Field:
     def __set__(self, instance, value):
         from dcorm import Model
 
-        type_hint = get_type_hints(
-            instance.__class__, locals() | Model._model_clss
-        )[self._name]
+        meta = instance._meta
 
         # Set default values
         if value is None:
@@ -29,118 +43,282 @@ class Field:
                 # This may also create a Model
                 value = self.default_factory()
             else:  # Figure out sensible value
+                type_hint = meta.type_hints[self._name]
                 if type_hint in (str, int, float, bool):
                     value = type_hint()
 
         # Convert values if necessary, such as str to UUID
-        if value is None:
-            # Don't convert
-            pass
-        elif issubclass(type_hint, Model):
-            # Is a relationship
-            rel_type_hint = get_type_hints(
-                type_hint, locals() | Model._model_clss
-            )["id"]
-            if isinstance(value, Model):
-                # relationship is already set
-                pass
-            elif rel_type_hint is not type(value):
-                # Relationship not set yet
-                # Will be properly set on post init of model
-                value = rel_type_hint(value)
-        elif type_hint is not type(value):
-            if issubclass(type_hint, datetime):
-                value = datetime.fromtimestamp(value)
-            else:
-                value = type_hint(value)
+        value = meta.converters[self._name](value)
 
         # Save value to instance
-        instance._descriptor_values[self._name] = value
-        instance._has_unsaved_changes = True
+        values = instance._descriptor_values
+        if instance._in_db:
+            instance._track_change(self._name, values.get(self._name), value)
+        else:
+            instance._mark_dirty()
+        values[self._name] = value
 
-        if not issubclass(value.__class__, Model):
+        if not isinstance(value, Model):
             return
 
-        type_hints = get_type_hints(
-            value.__class__, locals() | Model._model_clss
-        )
         name = self.backref or instance.__class__.__name__.lower()
-        descriptor = getattr(value, name, None)
-        if isinstance(descriptor, Collection):
+        if name in value._meta.collections:
             # Set back relationship one-to-many
-            if instance not in descriptor:
+            descriptor = getattr(value, name, None)
+            if isinstance(descriptor, Collection):
                 descriptor.append(instance)
-        else:  # Try to get Field backref
-            try:
-                descriptor = value.fields()[name]
-            except KeyError:
-                pass  # No back reference
-            else:
-                # Set back relationship
-                if isinstance(descriptor, Field):
-                    if getattr(value, name) is not instance:
-                        setattr(value, name, instance)
-                else:
-                    raise ValueError("Backref of wrong format")  # ToDo: improve error
+        elif name in value._meta.fields:
+            # Set back relationship
+            if value._descriptor_values.get(name) is not instance:
+                setattr(value, name, instance)
 
     def __get__(self, instance, owner):
+        if instance is None:
+            if "_meta" in owner.__dict__:
+                # Registered, build conditions, like `User.name == "Bob"`
+                return Column(owner, self._name)
+            return None  # No default while the dataclass is created
         try:
-            return instance._descriptor_values[self._name]
+            value = instance._descriptor_values[self._name]
         except (AttributeError, KeyError):
             return None
+        if value is None:
+            return None
+        target = instance._meta.relations.get(self._name)
+        if target is None or isinstance(value, target):
+            return value
+        # Only the id of the related instance is known yet
+        return self._load(instance, target, value)
 
+    def _load(self, instance, target, id_):
+        if self.loading == NOLOAD:
+            return target._cache.peek(id_)
+        related = target.get(id=id_)
+        if related is not None:
+            # Not a change, the same id is still stored
+            instance._descriptor_values[self._name] = related
+        return related
 
-@dataclass
+
+@dataclass(eq=False)
 class Collection:
+    """Related instances in the order they were added.
+
+    They are indexed by their id, so checking whether an instance is in
+    the collection, adding and removing it take constant time. Another
+    instance of the same row, loaded after the identity map dropped the
+    first, takes its place.
+    """
     backref: str
-    relationships: list = field(default_factory=list)
+    loading: str = LAZY
     model = None
+    # Whether the collection contains everything from the database
+    _loaded = False
+    # Related instances by their key, see _key, in order
+    _members: dict = field(default_factory=dict, init=False, repr=False)
+    # List of the related instances until they change
+    _list: list = field(default=None, init=False, repr=False)
+    # Instances removed since the model was saved, which are saved with it
+    _removed: dict = field(default_factory=dict, init=False, repr=False)
+    # Instances added to a many-to-many collection since the model was
+    # saved, whose rows in the join table are written with it
+    _inserted: dict = field(default_factory=dict, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.loading not in LOADING:
+            raise ValueError(f"loading needs to be one of {LOADING}")
 
     def __set_name__(self, owner, name):
         self._model_class = owner
         self._field_name = name
 
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        # Until the instance is initialized, its collection is this one
+        return instance._descriptor_values.get(self._field_name, self)
+
+    def __set__(self, instance, value):
+        # Kept with the field values, as instances of compact models have
+        # no __dict__
+        instance._descriptor_values[self._field_name] = value
+
+    def __deepcopy__(self, memo):
+        # Copies are different objects, so the index is built anew
+        collection = copy(self)
+        memo[id(self)] = collection
+        collection.model = deepcopy(self.model, memo)
+        collection._members = {}
+        collection._list = None
+        collection._removed = {}
+        collection._inserted = {}
+        for item in self._members.values():
+            collection._add(deepcopy(item, memo))
+        return collection
+
+    @property
+    def relationships(self) -> list:
+        """The related instances loaded so far."""
+        if self._list is None:
+            self._list = list(self._members.values())
+        return self._list
+
     def __getitem__(self, item):
+        self._load()
         return self.relationships[item]
 
     def __contains__(self, item):
-        return item in self.relationships
+        self._load()
+        return _key(item) in self._members
 
     def __len__(self):
-        return len(self.relationships)
+        self._load()
+        return len(self._members)
 
     def __iter__(self):
+        self._load()
         return iter(self.relationships)
 
     def remove(self, item):
-        self.relationships.remove(item)
-        if self.backref in item.fields():
-            setattr(item, self.backref, None)
-        elif self.backref in item.collections():
-            collection = getattr(item, self.backref)
-            if self in collection:
-                collection.remove(self)
-        self.model._has_unsaved_changes = True
+        self.remove_many((item,))
+
+    def remove_many(self, items):
+        """Removes all items, unsetting their backrefs, or raises a
+        ValueError without removing any if one isn't in the collection."""
+        self._load()
+        members = self._members
+        items = {_key(item): item for item in items}
+        for key, item in items.items():
+            if key not in members:
+                raise ValueError(f"{item!r} is not in the collection")
+        for key, item in items.items():
+            del members[key]
+            self._inserted.pop(key, None)
+            self._removed[key] = item
+        items = list(items.values())
+        self._list = None
+
+        for item in items:
+            if self.backref in item._meta.fields:
+                setattr(item, self.backref, None)
+            elif self.backref in item._meta.collections:
+                collection = getattr(item, self.backref)
+                if self.model in collection:
+                    collection.remove(self.model)
+        if items:
+            self.model._mark_dirty()
 
     def append(self, other):
-        self.relationships.append(other)
-
-        type_hints = get_type_hints(
-            other.__class__, locals() | self.model._model_clss
-        )
-        type_hint = type_hints[self.backref]
-        list_model_types = (
-            list[self._model_class], list[self._model_class.__name__]
-        )
-        if type_hint in list_model_types:
-            # many-to-many relationship
-            other_collection = getattr(other, self.backref)
-            if self.model not in other_collection:
-                other_collection.append(self.model)
-
-        elif type_hint is self._model_class:
-            # many-to-one relationship
-            setattr(other, self.backref, self.model)
-        else:
-            raise ValueError("Backref isn't of the right type")
-        self.model._has_unsaved_changes = True
+        self.extend((other,))
+
+    def extend(self, others):
+        """Adds the instances which aren't in the collection yet and sets
+        their backrefs."""
+        # Doesn't need to load the collection, what is loaded later is
+        # merged with what was appended
+        members = self._members
+        added = {}
+        for other in others:
+            key = _key(other)
+            if key not in members:
+                added[key] = other
+        if not added:
+            return
+        many_to_many = []
+        for other in added.values():
+            other_meta = other._meta
+            if other_meta.collection_targets.get(self.backref) is \
+                    self._model_class:
+                many_to_many.append(True)
+            elif other_meta.relations.get(self.backref) is self._model_class:
+                many_to_many.append(False)
+            else:
+                raise ValueError("Backref isn't of the right type")
+        members.update(added)
+        self._list = None
+        for key in added:
+            self._removed.pop(key, None)
+
+        for (key, other), is_many_to_many in zip(added.items(), many_to_many):
+            if is_many_to_many:
+                self._inserted[key] = other
+                getattr(other, self.backref).append(self.model)
+            else:
+                setattr(other, self.backref, self.model)
+        self.model._mark_dirty()
+
+    def _bind(self, model):
+        """Copy of this collection belonging to one model instance."""
+        collection = copy(self)
+        collection._members = dict(self._members)
+        collection._list = None
+        collection._removed = {}
+        collection._inserted = {}
+        collection.model = model
+        collection._loaded = self.loading == NOLOAD
+        return collection
+
+    def _add(self, item):
+        """Adds the item, or puts it in the place of another instance of
+        its row, without setting its backref or marking the model
+        changed."""
+        key = _key(item)
+        if self._members.get(key) is not item:
+            self._members[key] = item
+            self._list = None
+
+    def _discard(self, item):
+        """Removes the item if it's there, without touching its backref
+        or marking the model changed."""
+        if self._members.pop(_key(item), None) is not None:
+            self._list = None
+
+    def _has(self, item) -> bool:
+        """Whether the item is in the collection, without loading it."""
+        return _key(item) in self._members
+
+    def _unsaved(self) -> tuple[dict, dict]:
+        """Instances added and removed since the model was saved, which
+        are forgotten, see `_restore`."""
+        unsaved = self._inserted, self._removed
+        self._inserted = {}
+        self._removed = {}
+        return unsaved
+
+    def _restore(self, inserted, removed):
+        """Takes back instances added and removed before a save which was
+        rolled back. Changes made since then take precedence."""
+        self._inserted = {
+            **{key: item for key, item in inserted.items()
+               if key not in self._removed},
+            **self._inserted,
+        }
+        self._removed = {
+            **{key: item for key, item in removed.items()
+               if key not in self._inserted},
+            **self._removed,
+        }
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        model = self.model
+        if model is None or not model._in_db:
+            # Nothing in the database yet
+            return
+        if self._field_name in model._meta.join_tables:
+            from dcorm.query import _load_members
+
+            _load_members(model.__class__, self._field_name, {model.id: self})
+            return
+        target = model._meta.collection_targets[self._field_name]
+        for relationship in target.find(**{self.backref: model.id}):
+            self._add(relationship)
+
+
+def _key(item):
+    """Key of a related instance in a collection, its id, or its identity
+    while it has none."""
+    id_ = item._descriptor_values.get("id")
+    return ("instance", id(item)) if id_ is None else id_
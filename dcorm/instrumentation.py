@@ -0,0 +1,109 @@
+from collections import Counter
+from dataclasses import dataclass, fields, replace
+from time import perf_counter
+
+from dcorm.mappers.base import AFTER_EXECUTE
+
+
+@dataclass
+class ModelStats:
+    """Counters of a model, see `Model.stats`.
+
+    Hits and misses are the ones of the model's identity map, hydrations
+    instances created from rows, and the others rows written.
+    """
+    hits: int = 0
+    misses: int = 0
+    hydrations: int = 0
+    inserts: int = 0
+    updates: int = 0
+    deletes: int = 0
+
+    def __sub__(self, other: "ModelStats") -> "ModelStats":
+        return replace(self, **{
+            field.name: getattr(self, field.name) - getattr(other, field.name)
+            for field in fields(self)
+        })
+
+    def __bool__(self) -> bool:
+        return any(getattr(self, field.name) for field in fields(self))
+
+
+class Recording:
+    """Records the statements mappers run and how the counters of the
+    models change while used as a context manager.
+
+    By default it listens to the mappers of all registered models. As
+    listeners are called for every thread, statements other threads run
+    in the meantime are recorded as well.
+
+    `executions` holds an Execution per statement and `models` the
+    changed ModelStats by model name once the block is left.
+    """
+
+    def __init__(self, *mappers):
+        self.mappers = mappers
+        self.executions = []
+        self.models = {}
+        self.duration = None
+        self._unlisten = []
+        self._stats = {}
+        self._start = None
+
+    def __enter__(self):
+        from dcorm import Model
+
+        mappers = self.mappers or tuple({
+            id(model_cls._db): model_cls._db
+            for model_cls in Model._model_clss.values()
+            if model_cls._db is not None
+        }.values())
+        self._unlisten = [
+            mapper.listen(AFTER_EXECUTE, self.executions.append)
+            for mapper in mappers
+        ]
+        self._stats = _model_stats()
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.duration = perf_counter() - self._start
+        for unlisten in self._unlisten:
+            unlisten()
+        self._unlisten = []
+        self.models = {}
+        for name, stats in _model_stats().items():
+            changed = stats - self._stats.get(name, ModelStats())
+            if changed:
+                self.models[name] = changed
+
+    @property
+    def database_time(self) -> float:
+        """Seconds spent running statements."""
+        return sum(execution.duration for execution in self.executions)
+
+    def repeated(self, minimum=2) -> list[tuple[str, int]]:
+        """Statements run at least `minimum` times with how often, most
+        frequent first, which points to N+1 queries."""
+        counts = Counter(execution.sql for execution in self.executions)
+        return [
+            (sql, count) for sql, count in counts.most_common()
+            if count >= minimum
+        ]
+
+    def slowest(self, n=10) -> list:
+        """The n executions which took longest."""
+        return sorted(
+            self.executions, key=lambda execution: execution.duration,
+            reverse=True
+        )[:n]
+
+
+def _model_stats() -> dict:
+    from dcorm import Model
+
+    return {
+        name: model_cls.stats()
+        for name, model_cls in Model._model_clss.items()
+        if model_cls._meta is not None
+    }
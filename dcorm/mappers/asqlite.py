@@ -0,0 +1,94 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from queue import Empty, SimpleQueue
+from threading import Thread
+
+from dcorm.mappers.sqlite import SQLite3
+
+
+class AsyncSQLite3(SQLite3):
+    """SQLite mapper which doesn't block the event loop.
+
+    Reads run in a pool of `readers` threads, each with a connection of
+    its own, so they overlap. Writes are queued for a single writer
+    thread, which runs everything queued in the meantime in one
+    transaction and commits it at once. A failing write only undoes its
+    own statements.
+
+    It can still be used like SQLite3 from synchronous code.
+    """
+
+    def __init__(self, db_path, cached_statements=256, *, readers=4, **pragmas):
+        super().__init__(db_path, cached_statements, **pragmas)
+        self._read_pool = ThreadPoolExecutor(
+            readers, thread_name_prefix="dcorm-read"
+        )
+        self._writes = SimpleQueue()
+        self._write_thread = Thread(
+            target=self._write_loop, name="dcorm-write", daemon=True
+        )
+        self._write_thread.start()
+
+    async def read(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_pool, partial(fn, *args))
+
+    async def write(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._writes.put((partial(fn, *args), loop, future))
+        return await future
+
+    def close(self):
+        self._writes.put(None)
+        self._write_thread.join()
+        self._read_pool.shutdown()
+        super().close()
+
+    def _write_loop(self):
+        while True:
+            jobs = [self._writes.get()]
+            while True:
+                try:
+                    jobs.append(self._writes.get_nowait())
+                except Empty:
+                    break
+            stop = None in jobs
+            jobs = [job for job in jobs if job is not None]
+            if jobs:
+                self._write_batch(jobs)
+            if stop:
+                return
+
+    def _write_batch(self, jobs):
+        con = self._begin()
+        results = []
+        try:
+            con.execute("BEGIN")
+            for fn, _, _ in jobs:
+                con.execute("SAVEPOINT dcorm_write")
+                try:
+                    results.append((fn(), None))
+                except Exception as exc:
+                    con.execute("ROLLBACK TO dcorm_write")
+                    results.append((None, exc))
+                con.execute("RELEASE dcorm_write")
+            con.commit()
+            self._committed()
+        except Exception as exc:
+            con.rollback()
+            results = [(None, exc)] * len(jobs)
+        finally:
+            self._end()
+        for (_, loop, future), (result, exc) in zip(jobs, results):
+            loop.call_soon_threadsafe(_settle, future, result, exc)
+
+
+def _settle(future, result, exc):
+    if future.done():
+        return  # Cancelled while waiting
+    if exc is None:
+        future.set_result(result)
+    else:
+        future.set_exception(exc)
@@ -1,4 +1,204 @@
+from dataclasses import dataclass
+from typing import Any
+
+from dcorm.expressions import where
+from dcorm.query import Query
+
+
+# Events listeners can be added for, see `Mapper.listen`
+BEFORE_EXECUTE = "before_execute"
+AFTER_EXECUTE = "after_execute"
+EVENTS = (BEFORE_EXECUTE, AFTER_EXECUTE)
+
+
+@dataclass(eq=False)
+class Execution:
+    """A statement run by a mapper, as passed to its listeners.
+
+    `params` is a list of parameters per row for statements run for many
+    rows at once. `rowcount` and `duration`, in seconds, are only set
+    after the statement ran. For selects they include reading the rows,
+    which is reported once the rows are read or no longer needed.
+    """
+    mapper: Any
+    sql: str
+    params: Any
+    model: type = None
+    rowcount: int = -1
+    duration: float = None
 
 
 class Mapper:
-    pass
+    """Interface between models and a database.
+
+    Writes happen inside a transaction which is only made permanent by
+    `commit`, so a session can group the writes of many models.
+
+    Listeners added with `listen` are told about every statement run.
+    Without any, mappers skip measuring statements altogether.
+    """
+
+    # Event names mapped to tuples of listeners, None without any
+    _listeners = None
+
+    def listen(self, event, listener):
+        """Calls listener with an Execution before or after each statement,
+        for the events BEFORE_EXECUTE and AFTER_EXECUTE. Returns a function
+        removing the listener again.
+
+        Listeners are called in the thread running the statement.
+        """
+        if event not in EVENTS:
+            raise ValueError(f"event needs to be one of {EVENTS}")
+        # Replaced instead of changed, so other threads calling listeners
+        # don't see a half changed dict
+        listeners = dict(self._listeners or {})
+        listeners[event] = listeners.get(event, ()) + (listener,)
+        self._listeners = listeners
+        return lambda: self.unlisten(event, listener)
+
+    def unlisten(self, event, listener):
+        listeners = dict(self._listeners or {})
+        remaining = tuple(
+            listener_ for listener_ in listeners.get(event, ())
+            if listener_ is not listener
+        )
+        if remaining:
+            listeners[event] = remaining
+        else:
+            listeners.pop(event, None)
+        self._listeners = listeners or None
+
+    def _before_execute(self, sql, params, model_cls=None) -> Execution:
+        execution = Execution(self, sql, params, model_cls)
+        for listener in (self._listeners or {}).get(BEFORE_EXECUTE, ()):
+            listener(execution)
+        return execution
+
+    def _after_execute(self, execution, rowcount, duration):
+        execution.rowcount = rowcount
+        execution.duration = duration
+        for listener in (self._listeners or {}).get(AFTER_EXECUTE, ()):
+            listener(execution)
+
+    def sync(self):
+        """Makes the models forget cached instances and query results of
+        rows other programs may have written since the last time, see
+        `Model.expire`. This version never notices any."""
+
+    def create(self, model_cls):
+        """Creates the storage for a model if it doesn't exist yet."""
+        raise NotImplementedError
+
+    def select(self, model_cls, query, batch_size=1000):
+        """Iterates over the rows of all instances matching the query,
+        reading `batch_size` rows from the database at a time.
+
+        Rows are tuples of the values of `query.columns`, or of all
+        fields in their order.
+        """
+        raise NotImplementedError
+
+    def select_members(self, model_cls, name, owner_ids, batch_size=1000):
+        """Iterates over the rows of the instances in the many-to-many
+        collection `name` of the instances with the owner_ids.
+
+        Rows are tuples of all fields of the related instance in their
+        order, followed by the stored id of the instance holding it.
+        """
+        raise NotImplementedError
+
+    def decoder(self, model_cls):
+        """Function creating an instance loaded from the database from a
+        row of all fields and its id, converted to the type of the field."""
+        fields = tuple(model_cls._meta.fields)
+
+        def decode(row, id_):
+            instance = model_cls(**dict(zip(fields, row)))
+            instance._in_db = True
+            instance._mark_clean()
+            return instance
+        return decode
+
+    def count(self, model_cls, query):
+        """Number of instances matching the query."""
+        raise NotImplementedError
+
+    def explain(self, model_cls, query):
+        """Describes how the database would run the query."""
+        raise NotImplementedError
+
+    def get(self, model_cls, query=None, **filters):
+        """Data of the first instance matching the filters or None."""
+        query = Query(where(model_cls, query, **filters), limit=1)
+        for row in self.select(model_cls, query, batch_size=1):
+            return dict(zip(model_cls._meta.fields, row))
+        return None
+
+    def find(self, model_cls, query=None, **filters):
+        """Data of all instances matching the filters."""
+        query = Query(where(model_cls, query, **filters))
+        for row in self.select(model_cls, query):
+            yield dict(zip(model_cls._meta.fields, row))
+
+    def _serealize_type(self, value):
+        """Converts a field value to how the database stores it."""
+        return value
+
+    def insert(self, model_cls, instances):
+        """Writes new instances of one model."""
+        raise NotImplementedError
+
+    def update(self, model_cls, instances):
+        """Writes the changed fields of instances of one model."""
+        raise NotImplementedError
+
+    def write_members(self, model_cls, name, added, removed):
+        """Writes the changes of the many-to-many collection `name` of
+        instances of one model, given as pairs of the instance holding
+        the collection and the one added to or removed from it."""
+        raise NotImplementedError
+
+    def update_where(self, model_cls, query, values):
+        """Sets the fields in values for all rows matching the query, with
+        a single statement. Returns the ids of the rows, as stored."""
+        raise NotImplementedError
+
+    def delete_where(self, model_cls, query):
+        """Deletes all rows matching the query with a single statement,
+        and their rows in join tables. Returns the ids of the rows, as
+        stored."""
+        raise NotImplementedError
+
+    def commit(self):
+        raise NotImplementedError
+
+    async def read(self, fn, *args):
+        """Runs a function reading from the database for async code.
+
+        This version simply calls it, mappers that support async code
+        run it without blocking the event loop.
+        """
+        return fn(*args)
+
+    async def write(self, fn, *args):
+        """Runs a function writing to the database for async code and
+        commits its writes, or rolls them back if it raises."""
+        try:
+            result = fn(*args)
+        except Exception:
+            self.rollback()
+            raise
+        self.commit()
+        return result
+
+    def rollback(self):
+        raise NotImplementedError
+
+    def save(self, model):
+        """Writes a single instance and commits it."""
+        if model._in_db:
+            self.update(model.__class__, [model])
+        else:
+            self.insert(model.__class__, [model])
+        self.commit()
@@ -0,0 +1,261 @@
+import atexit
+from threading import Event, Lock, Thread, local
+
+from dcorm.mappers.base import Mapper
+from dcorm.storage import NO_CHANGES
+
+
+class WriteBehind(Mapper):
+    """Mapper wrapping another one, which writes saved instances later.
+
+    Inserts and updates are kept in memory once committed, so saving
+    returns without waiting for the database, and a background thread
+    writes them in one transaction once `max_pending` instances are
+    waiting or after `interval` seconds. Saving an instance again before
+    that only writes its last values. `flush` writes them right away,
+    and `close`, also called when Python exits, writes the rest.
+
+    Reads write whatever is pending first, so they see it. Bulk updates
+    and deletes go to the wrapped mapper directly, after everything
+    saved before. If writing in the background fails, those writes are
+    lost and the error is raised by the next save or flush.
+    """
+
+    def __init__(self, mapper: Mapper, *, max_pending=1000, interval=1.0):
+        self.mapper = mapper
+        self.max_pending = max_pending
+        self.interval = interval
+        # Committed writes: the latest _Snapshot by model and id, and the
+        # changes of many-to-many collections in order
+        self._pending = {}
+        self._members = []
+        self._lock = Lock()
+        # Held while writing, so batches are written in order
+        self._flush_lock = Lock()
+        # Per thread, the writes of its transaction and whether the
+        # wrapped mapper has a transaction of it open
+        self._local = local()
+        self._error = None
+        self._closed = False
+        self._wake = Event()
+        self._thread = Thread(
+            target=self._run, name="dcorm-write-behind", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self._flush()
+            except Exception as exc:
+                self._error = exc
+
+    def flush(self):
+        """Writes and commits all pending writes of earlier commits."""
+        self._raise_error()
+        self._flush()
+
+    def _flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, members = self._pending, self._members
+                self._pending, self._members = {}, []
+            if not pending and not members:
+                return
+            try:
+                self._write(pending, members)
+            except Exception:
+                self.mapper.rollback()
+                raise
+            self.mapper.commit()
+
+    def close(self):
+        """Writes everything pending, stops the background thread and
+        closes the wrapped mapper."""
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        self._wake.set()
+        self._thread.join()
+        self._flush()
+        close = getattr(self.mapper, "close", None)
+        if close is not None:
+            close()
+
+    def _raise_error(self):
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _write(self, pending, members):
+        """Writes snapshots by model and id and collection changes with
+        the wrapped mapper, without committing them."""
+        by_model = {}
+        for (model_cls, _), snapshot in pending.items():
+            new, changed = by_model.setdefault(model_cls, ([], []))
+            (new if snapshot.new else changed).append(snapshot)
+        for model_cls, (new, changed) in by_model.items():
+            if new:
+                self.mapper.insert(model_cls, new)
+            if changed:
+                self.mapper.update(model_cls, changed)
+        for args in members:
+            self.mapper.write_members(*args)
+
+    def _staged(self) -> list:
+        """Writes of the current thread's transaction."""
+        staged = getattr(self._local, "staged", None)
+        if staged is None:
+            staged = self._local.staged = []
+        return staged
+
+    def _direct(self):
+        """Writes the current thread's writes to the wrapped mapper in a
+        transaction which stays open until it commits, after flushing
+        the writes of earlier commits."""
+        if not getattr(self._local, "direct", False):
+            self.flush()
+            self._local.direct = True
+        staged = self._staged()
+        if staged:
+            self._local.staged = []
+            pending, members = {}, []
+            _coalesce(staged, pending, members)
+            self._write(pending, members)
+
+    def _read(self):
+        """Makes pending writes visible to reads of the current thread."""
+        if self._staged() or getattr(self._local, "direct", False):
+            self._direct()
+        else:
+            # Also waits for a batch the background thread is writing
+            self.flush()
+
+    async def read(self, fn, *args):
+        return await self.mapper.read(fn, *args)
+
+    def listen(self, event, listener):
+        return self.mapper.listen(event, listener)
+
+    def unlisten(self, event, listener):
+        self.mapper.unlisten(event, listener)
+
+    def sync(self):
+        self.mapper.sync()
+
+    def create(self, model_cls):
+        self.mapper.create(model_cls)
+
+    def select(self, model_cls, query, batch_size=1000):
+        self._read()
+        return self.mapper.select(model_cls, query, batch_size)
+
+    def select_members(self, model_cls, name, owner_ids, batch_size=1000):
+        self._read()
+        return self.mapper.select_members(
+            model_cls, name, owner_ids, batch_size
+        )
+
+    def decoder(self, model_cls):
+        return self.mapper.decoder(model_cls)
+
+    def count(self, model_cls, query):
+        self._read()
+        return self.mapper.count(model_cls, query)
+
+    def explain(self, model_cls, query):
+        return self.mapper.explain(model_cls, query)
+
+    def _serealize_type(self, value):
+        return self.mapper._serealize_type(value)
+
+    def insert(self, model_cls, instances):
+        snapshots = [_Snapshot(instance, True) for instance in instances]
+        self._staged().append(("rows", model_cls, snapshots))
+
+    def update(self, model_cls, instances):
+        snapshots = [_Snapshot(instance, False) for instance in instances]
+        self._staged().append(("rows", model_cls, snapshots))
+
+    def write_members(self, model_cls, name, added, removed):
+        self._staged().append(("members", model_cls, name, added, removed))
+
+    def update_where(self, model_cls, query, values):
+        self._direct()
+        return self.mapper.update_where(model_cls, query, values)
+
+    def delete_where(self, model_cls, query):
+        self._direct()
+        return self.mapper.delete_where(model_cls, query)
+
+    def commit(self):
+        staged = self._staged()
+        self._local.staged = []
+        if getattr(self._local, "direct", False):
+            self._local.direct = False
+            pending, members = {}, []
+            _coalesce(staged, pending, members)
+            try:
+                self._write(pending, members)
+            except Exception:
+                self.mapper.rollback()
+                raise
+            self.mapper.commit()
+        elif staged:
+            with self._lock:
+                _coalesce(staged, self._pending, self._members)
+                full = len(self._pending) >= self.max_pending
+            if full:
+                self._wake.set()
+        self._raise_error()
+
+    def rollback(self):
+        self._local.staged = []
+        if getattr(self._local, "direct", False):
+            self._local.direct = False
+            self.mapper.rollback()
+
+
+class _Snapshot:
+    """Values of an instance when it was saved, which are written in its
+    place, as it may change or be saved again in the meantime."""
+    __slots__ = ("id", "new", "_descriptor_values", "_changes")
+
+    def __init__(self, instance, new):
+        meta = instance._meta
+        values = meta.values()
+        stored = instance._descriptor_values
+        for name in meta.fields:
+            values[name] = stored.get(name)
+        self.id = stored.get("id")
+        self.new = new
+        self._descriptor_values = values
+        self._changes = (
+            NO_CHANGES if new else dict.fromkeys(instance._changes)
+        )
+
+
+def _coalesce(staged, pending, members):
+    """Adds staged writes to the snapshots by model and id, keeping only
+    the latest values of each instance, and the collection changes."""
+    for kind, model_cls, *write in staged:
+        if kind == "members":
+            members.append((model_cls, *write))
+            continue
+        snapshots, = write
+        for snapshot in snapshots:
+            key = (model_cls, snapshot.id)
+            earlier = pending.get(key)
+            if earlier is not None:
+                if earlier.new:
+                    snapshot.new = True
+                    snapshot._changes = NO_CHANGES
+                else:
+                    snapshot._changes = {
+                        **earlier._changes, **snapshot._changes
+                    }
+            pending[key] = snapshot
@@ -0,0 +1,300 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import replace
+from itertools import islice
+from threading import get_ident
+from typing import Type
+from zlib import crc32
+
+from dcorm import Model
+from dcorm.expressions import And, Column, Comparison, In
+from dcorm.mappers.base import Mapper
+from dcorm.mappers.sqlite import SQLite3, _merge, _selected, _unpaged
+from dcorm.query import Query
+
+
+class ShardedSQLite3(Mapper):
+    """Mapper spreading the rows of every model over several SQLite
+    databases, one SQLite3 mapper per path, by a hash of their id.
+
+    Queries for ids only run on the shards holding them. Others run on
+    all shards at once, in a pool of `workers` threads which read a
+    batch ahead of the rows being used, and their rows are merged,
+    sorted and paged like the rows of a single database would be.
+    Writes are grouped per shard, with one statement per shard where
+    SQLite3 would run one.
+
+    Each shard commits on its own, so a failing commit can leave the
+    others committed. The pairs of many-to-many collections are stored
+    with the instance on the side owning the join table. The number of
+    shards can't change without moving the rows. Other keyword
+    arguments, like `check_interval` or pragmas, are passed on to each
+    SQLite3 mapper.
+    """
+
+    def __init__(self, db_paths, *, workers=None, **options):
+        if not db_paths:
+            raise ValueError("At least one database path is needed")
+        self.shards = [SQLite3(db_path, **options) for db_path in db_paths]
+        self._pool = ThreadPoolExecutor(
+            workers or len(self.shards), thread_name_prefix="dcorm-shard"
+        )
+
+    def close(self):
+        self._pool.shutdown()
+        for shard in self.shards:
+            shard.close()
+
+    def listen(self, event, listener):
+        unlisten = [shard.listen(event, listener) for shard in self.shards]
+
+        def remove():
+            for unlisten_ in unlisten:
+                unlisten_()
+        return remove
+
+    def unlisten(self, event, listener):
+        for shard in self.shards:
+            shard.unlisten(event, listener)
+
+    def sync(self):
+        for shard in self.shards:
+            shard.sync()
+
+    def shard(self, stored_id) -> SQLite3:
+        """The shard holding the row with an id, as it is stored."""
+        return self.shards[self._index(stored_id)]
+
+    def _index(self, stored_id) -> int:
+        # Unlike hash, the same in every process
+        return crc32(str(stored_id).encode()) % len(self.shards)
+
+    def _routed(self, model_cls: Type[Model], query: Query) -> list:
+        """Shards with rows the query can match, each with the query for
+        its rows. Queries for ids chosen from only look for the ones in
+        each shard."""
+        condition = query.where
+        terms = condition.terms if isinstance(condition, And) else (condition,)
+        for term in terms:
+            if isinstance(term, Comparison) and term.operator == "=" and (
+                term.column.name == "id"
+            ):
+                return [(self.shard(term.value), query)]
+            if isinstance(term, In) and term.column.name == "id":
+                by_shard = {}
+                for value in term.values:
+                    by_shard.setdefault(self._index(value), []).append(value)
+                routed = []
+                for index, values in sorted(by_shard.items()):
+                    chosen = replace(term, values=tuple(values))
+                    if condition is term:
+                        where = chosen
+                    else:
+                        where = And(tuple(
+                            chosen if term_ is term else term_
+                            for term_ in terms
+                        ))
+                    routed.append(
+                        (self.shards[index], replace(query, where=where))
+                    )
+                return routed
+        return [(shard, query) for shard in self.shards]
+
+    def _by_shard(self, model_cls: Type[Model], instances) -> dict:
+        """Instances grouped by the shard holding their rows."""
+        encode = self.shards[0]._codec(model_cls).encoder(("id",))
+        by_shard = {}
+        for instance in instances:
+            index = self._index(encode(instance)[0])
+            by_shard.setdefault(index, []).append(instance)
+        return {
+            self.shards[index]: instances_
+            for index, instances_ in by_shard.items()
+        }
+
+    def _inline(self, shard: SQLite3) -> bool:
+        """Whether the current thread needs to read the shard itself, as
+        it is in the middle of writing to it."""
+        return shard._writer == get_ident()
+
+    def _map(self, fn, routed) -> list:
+        """Results of fn(shard, query) for each of the routed queries,
+        run in the pool at the same time."""
+        if len(routed) == 1:
+            return [fn(*routed[0])]
+        futures = [
+            None if self._inline(shard) else
+            self._pool.submit(fn, shard, query)
+            for shard, query in routed
+        ]
+        return [
+            fn(shard, query) if future is None else future.result()
+            for (shard, query), future in zip(routed, futures)
+        ]
+
+    def _ahead(self, shard: SQLite3, rows, batch_size):
+        """Iterates over the rows of a shard, reading the next batch in the
+        pool while the current one is used, from now on."""
+        if self._inline(shard):
+            return rows
+
+        def fetch():
+            return list(islice(rows, batch_size))
+        return self._batches(rows, fetch, self._pool.submit(fetch), batch_size)
+
+    def _batches(self, rows, fetch, future, batch_size):
+        try:
+            while True:
+                batch = future.result()
+                if len(batch) < batch_size:
+                    future = None
+                    yield from batch
+                    return
+                future = self._pool.submit(fetch)
+                yield from batch
+        finally:
+            # The rows can only be closed once no batch is read anymore
+            if future is not None and not future.cancel():
+                wait((future,))
+            rows.close()
+
+    def create(self, model_cls: Type[Model]):
+        for shard in self.shards:
+            shard.create(model_cls)
+
+    def select(self, model_cls: Type[Model], query: Query, batch_size=1000):
+        routed = self._routed(model_cls, query)
+        if len(routed) == 1:
+            shard, query_ = routed[0]
+            return shard.select(model_cls, query_, batch_size)
+        columns, selected = _selected(model_cls, query)
+        rows = [
+            self._ahead(shard, shard.select(
+                model_cls, replace(_unpaged(query_), columns=selected),
+                batch_size
+            ), batch_size)
+            for shard, query_ in routed
+        ]
+        return _merge(query, columns, selected, rows)
+
+    def select_members(
+        self, model_cls: Type[Model], name: str, owner_ids, batch_size=1000
+    ):
+        """Reads the ids in the join tables of the shards first, then the
+        rows of the related instances from the shards holding them."""
+        target = model_cls._meta.collection_targets[name]
+        query = Query(Column(model_cls, "id").in_(owner_ids))
+        if model_cls._meta.join_tables[name].owning:
+            routed = self._routed(model_cls, query)
+        else:
+            # Stored with the instances of the other side
+            routed = [(shard, query) for shard in self.shards]
+        pairs = [
+            self._ahead(shard, shard.select_member_ids(
+                model_cls, name, query_.where.values, batch_size
+            ), batch_size)
+            for shard, query_ in routed
+        ]
+        id_index = tuple(target._meta.fields).index("id")
+        pairs = (pair for pairs_ in pairs for pair in pairs_)
+        while batch := list(islice(pairs, batch_size)):
+            ids = tuple(dict.fromkeys(member_id for member_id, _ in batch))
+            rows = {
+                row[id_index]: row for row in self.select(
+                    target, Query(In(Column(target, "id"), ids)), batch_size
+                )
+            }
+            for member_id, owner_id in batch:
+                row = rows.get(member_id)
+                if row is not None:
+                    yield row + (owner_id,)
+
+    def decoder(self, model_cls: Type[Model]):
+        return self.shards[0].decoder(model_cls)
+
+    def _serealize_type(self, value):
+        return self.shards[0]._serealize_type(value)
+
+    def count(self, model_cls: Type[Model], query: Query) -> int:
+        paged = query.limit is not None or query.offset
+        if paged:
+            # Paged after adding up the rows of all shards
+            unpaged = replace(query, limit=None, offset=0)
+        else:
+            unpaged = query
+        total = sum(self._map(
+            lambda shard, query_: shard.count(model_cls, query_),
+            self._routed(model_cls, unpaged),
+        ))
+        if paged:
+            total = max(total - query.offset, 0)
+            if query.limit is not None:
+                total = min(total, query.limit)
+        return total
+
+    def explain(self, model_cls: Type[Model], query: Query) -> list[str]:
+        """How SQLite executes the query on the first shard it runs on."""
+        shard, query_ = next(iter(self._routed(model_cls, query)), (
+            self.shards[0], query
+        ))
+        return shard.explain(model_cls, query_)
+
+    def insert(self, model_cls: Type[Model], instances):
+        for shard, instances_ in self._by_shard(model_cls, instances).items():
+            shard.insert(model_cls, instances_)
+
+    def update(self, model_cls: Type[Model], instances):
+        for shard, instances_ in self._by_shard(model_cls, instances).items():
+            shard.update(model_cls, instances_)
+
+    def write_members(self, model_cls: Type[Model], name: str, added, removed):
+        encode = self.shards[0]._codec(model_cls).encoder(("id",))
+        by_shard = {}
+        for pairs, index in ((added, 0), (removed, 1)):
+            for owner, member in pairs:
+                shard = self.shard(encode(owner)[0])
+                by_shard.setdefault(shard, ([], []))[index].append(
+                    (owner, member)
+                )
+        for shard, (added_, removed_) in by_shard.items():
+            shard.write_members(model_cls, name, added_, removed_)
+
+    def update_where(self, model_cls: Type[Model], query: Query, values):
+        return self._write_where(
+            model_cls, query,
+            lambda shard, query_: shard.update_where(model_cls, query_, values)
+        )
+
+    def delete_where(self, model_cls: Type[Model], query: Query):
+        ids = self._write_where(
+            model_cls, query,
+            lambda shard, query_: shard.delete_where(model_cls, query_)
+        )
+        join_tables = model_cls._meta.join_tables.values()
+        if ids and not all(join.owning for join in join_tables):
+            # Their pairs are stored with the instances of the other side
+            for shard in self.shards:
+                shard._delete_members(shard._begin(), model_cls, ids)
+        return ids
+
+    def _write_where(self, model_cls: Type[Model], query: Query, write):
+        """Runs write(shard, query) on every shard with rows matching the
+        query, in the current thread, which holds their transactions."""
+        if query.order_by or query.limit is not None or query.offset:
+            # Paged over all shards, so the rows are chosen by their ids
+            ids = [
+                row[0] for row in
+                self.select(model_cls, replace(query, columns=("id",)))
+            ]
+            query = Query(In(Column(model_cls, "id"), tuple(ids)))
+        ids = []
+        for shard, query_ in self._routed(model_cls, query):
+            ids.extend(write(shard, query_))
+        return ids
+
+    def commit(self):
+        for shard in self.shards:
+            shard.commit()
+
+    def rollback(self):
+        for shard in self.shards:
+            shard.rollback()
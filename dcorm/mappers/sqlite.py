@@ -1,19 +1,188 @@
 import sqlite3
+from dataclasses import replace
 from datetime import datetime
 from enum import Enum
+from heapq import merge
+from itertools import chain, islice
+from operator import attrgetter
 from sqlite3 import OperationalError
-from typing import Type, Iterator
+from threading import Lock, get_ident, local
+from time import monotonic, perf_counter
+from typing import Type
 from uuid import UUID
 
 from dcorm import Model
+from dcorm.codec import Codec
+from dcorm.expressions import (
+    Column,
+    And, Comparison, In, IsNull, Match, Not, Or, sort_key
+)
 from dcorm.mappers.base import Mapper
+from dcorm.query import Query
 
 
 class SQLite3(Mapper):
-    def __init__(self, db_path):
+    """Mapper for an SQLite database, usable from several threads.
+
+    Writes go through a single connection, which the writing thread
+    holds from its first write until it commits or rolls back. Reads use
+    a connection per thread, so threads read concurrently, also while
+    another one writes if the journal mode is WAL. A thread in the middle
+    of writing reads through the writing connection to see its changes.
+
+    In-memory databases only exist for the connection that opened them,
+    so all threads share that one.
+
+    With `check_interval`, the mapper looks for writes by other processes
+    at most that often, in seconds, before using cached instances or
+    running queries. Triggers count the changes to each table in
+    `dcorm_changes`, so only the models whose tables changed forget what
+    they cached, see `Model.expire`. The triggers also slow down writes
+    of processes which don't check.
+    """
+
+    def __init__(
+        self, db_path, cached_statements=256, *, journal_mode="wal",
+        synchronous=None, mmap_size=None, cache_size=None, timeout=5.0,
+        check_interval=None
+    ):
         self.db_path = db_path
-        self.con = sqlite3.connect(db_path)
-        self.cur = self.con.cursor()
+        self.cached_statements = cached_statements
+        # Set on every connection, None keeps SQLite's default
+        self.pragmas = {
+            name: value for name, value in (
+                ("journal_mode", journal_mode),
+                ("synchronous", synchronous),
+                ("mmap_size", mmap_size),
+                ("cache_size", cache_size),
+            ) if value is not None
+        }
+        # Seconds to wait for a lock held by another connection
+        self.timeout = timeout
+        self._memory = db_path == ":memory:" or "mode=memory" in str(db_path)
+        self._local = local()
+        self._write_lock = Lock()
+        self._writer = None  # Thread writing right now
+        self.con = self._connect()
+        try:
+            self.max_variables = self.con.getlimit(
+                sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER
+            )
+        except AttributeError:  # Python < 3.11
+            self.max_variables = 999
+        # SQL text per table, operation and shape of the statement. Reusing
+        # the exact same text lets sqlite3 reuse the prepared statement.
+        self._statements = {}
+        self._codecs = {}
+        # Models by the tables they are stored in, join tables included
+        self._models = {}
+        self.check_interval = check_interval
+        self._next_check = 0.0
+        # PRAGMA data_version of the writing connection, which only changes
+        # when other connections commit, and the change counters of the
+        # tables at that time
+        self._data_version = None
+        self._versions = {}
+        if check_interval is not None:
+            con = self._begin()
+            try:
+                self._execute(con, _CHANGES_TABLE_SQL)
+            finally:
+                self.commit()
+            self._changed_tables(con)
+
+    def _connect(self):
+        con = sqlite3.connect(
+            self.db_path, timeout=self.timeout,
+            cached_statements=self.cached_statements,
+            # The writing connection is passed between threads, guarded
+            # by the write lock
+            check_same_thread=False,
+            uri=str(self.db_path).startswith("file:"),
+        )
+        for name, value in self.pragmas.items():
+            con.execute(f"PRAGMA {name} = {value}")
+        return con
+
+    def _reader(self):
+        """Connection for reading in the current thread."""
+        if self._memory or self._writer == get_ident():
+            return self.con
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = self._local.con = self._connect()
+        return con
+
+    def _begin(self):
+        """The writing connection, held by the current thread until it
+        commits or rolls back."""
+        if self._writer != get_ident():
+            self._write_lock.acquire()
+            self._writer = get_ident()
+        return self.con
+
+    def _end(self):
+        self._writer = None
+        self._write_lock.release()
+
+    def close(self):
+        """Closes the writing and the current thread's reading connection."""
+        con = getattr(self._local, "con", None)
+        if con is not None:
+            con.close()
+            del self._local.con
+        self.con.close()
+
+    def sync(self):
+        if self.check_interval is None:
+            return
+        now = monotonic()
+        if now < self._next_check:
+            return
+        if self._writer == get_ident():
+            changed = self._changed_tables(self.con)
+        elif self._write_lock.acquire(blocking=False):
+            try:
+                changed = self._changed_tables(self.con)
+            finally:
+                self._write_lock.release()
+        else:
+            # The connection is busy writing, checked again next time
+            return
+        self._next_check = now + self.check_interval
+        models = {}
+        for table in changed:
+            for model_cls in self._models.get(table, ()):
+                models[model_cls] = None
+        for model_cls in models:
+            model_cls.expire()
+
+    def _changed_tables(self, con) -> list:
+        """Tables other connections changed since the last check."""
+        version = self._execute(con, "PRAGMA data_version")[0][0]
+        if version == self._data_version:
+            return []
+        # Read after the version, so changes committed in between are
+        # found now and again next time, but never missed
+        versions = dict(self._execute(con, _CHANGES_SQL))
+        changed = [
+            table for table, count in versions.items()
+            if self._versions.get(table) != count
+        ]
+        self._data_version = version
+        self._versions = versions
+        return changed
+
+    def _committed(self):
+        """Takes the changes of a commit through the writing connection
+        into the known change counters, if no other connection committed
+        in the meantime, so they don't count as changes by others."""
+        if self.check_interval is None:
+            return
+        versions = dict(self._execute(self.con, _CHANGES_SQL))
+        version = self._execute(self.con, "PRAGMA data_version")[0][0]
+        if version == self._data_version:
+            self._versions = versions
 
     def _serealize_type(self, value):
         if isinstance(value, UUID):
@@ -24,84 +193,703 @@ class SQLite3(Mapper):
             return value.timestamp()
         return value
 
-    def _filter(self, model_cls: Type[Model], **filters):
-        table = model_cls.__name__.lower()
+    def _execute(self, con, sql, params=(), model_cls=None) -> list:
+        """Runs a statement on a cursor of its own and returns all rows it
+        results in, see `_rows` for reading them in batches."""
+        if self._listeners is None:
+            cursor = self._cursor(con.execute, sql, params)
+            try:
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+        execution = self._before_execute(sql, params, model_cls)
+        start = perf_counter()
+        cursor = self._cursor(con.execute, sql, params)
+        try:
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        # Only changes are counted, otherwise the rows read are
+        rowcount = len(rows) if cursor.rowcount < 0 else cursor.rowcount
+        self._after_execute(execution, rowcount, perf_counter() - start)
+        return rows
 
-        filters_ = {
-            k: self._serealize_type(v)
-            for k, v in filters.items()
-        }
-        filters_ = " AND ".join(
-            f"`{k}`={repr(v)}" for k, v in filters_.items()
+    def _executemany(self, sql, rows, model_cls=None):
+        con = self._begin()
+        if self._listeners is None:
+            self._cursor(con.executemany, sql, rows).close()
+            return
+        execution = self._before_execute(sql, rows, model_cls)
+        start = perf_counter()
+        cursor = self._cursor(con.executemany, sql, rows)
+        self._after_execute(
+            execution, cursor.rowcount, perf_counter() - start
         )
-        sql = "\n".join((
-            "SELECT *"
-            f"FROM `{table}`",
-            f"WHERE {filters_}" if filters_ else "",
-        ))
+        cursor.close()
+
+    def _cursor(self, execute, sql, params):
         try:
-            return self.cur.execute(sql)
+            return execute(sql, params)
         except OperationalError as exc:
             raise OperationalError(f"Bad format '{sql}'") from exc
 
-    def get(self, model_cls: Type[Model], query=None, **filters) -> Model:
-        # ToDo: return data instead of Model
-        res = self._filter(model_cls, **filters)
-        data = res.fetchone()
-        if not data:
-            return None
-        data = dict(zip(model_cls.fields().keys(), data))
-        model = model_cls.from_json(**data)
-        model._in_db = True
-        return model
-
-    def find(self, model_cls: Type[Model], query=None, **filters) -> Iterator[Model]:
-        res = self._filter(model_cls, **filters)
-        datas = res.fetchall()
-        for data in datas:
-            data = dict(zip(model_cls.fields().keys(), data))
-            yield data
+    def _select_sql(self, model_cls: Type[Model], query: Query, count=False):
+        condition = query.where
+        key = (
+            model_cls, "count" if count else "select",
+            None if condition is None else condition.shape(),
+            query.order_by, query.limit is not None, bool(query.offset),
+            query.columns,
+        )
+        sql = self._statements.get(key)
+        if sql is None:
+            meta = model_cls._meta
+            paged = query.limit is not None or query.offset
+            if count:
+                columns = "1" if paged else "COUNT(*)"
+            else:
+                columns = ", ".join(
+                    f"`{name}`" for name in query.columns or meta.fields
+                )
+            order_by = ", ".join(
+                f"`{name}` DESC" if descending else f"`{name}`"
+                for name, descending in query.order_by
+            )
+            limit = ""
+            if paged:
+                # SQLite only knows OFFSET together with LIMIT
+                limit = "LIMIT ?" if query.limit is not None else "LIMIT -1"
+                if query.offset:
+                    limit += " OFFSET ?"
+            sql = "\n".join(filter(None, (
+                f"SELECT {columns}",
+                f"FROM `{meta.table}`",
+                "" if condition is None else
+                f"WHERE {self._condition_sql(condition)}",
+                f"ORDER BY {order_by}" if order_by else "",
+                limit,
+            )))
+            if count and paged:
+                sql = f"SELECT COUNT(*) FROM (\n{sql}\n)"
+            self._statements[key] = sql
+        return sql
 
-    def create(self, model: Type[Model]):
-        attrs = list(model.fields().keys())
-        table = model.__name__.lower()
+    def _condition_sql(self, condition) -> str:
+        if isinstance(condition, Comparison):
+            return f"`{condition.column.name}` {condition.operator} ?"
+        if isinstance(condition, IsNull):
+            negated = " NOT" if condition.negated else ""
+            return f"`{condition.column.name}` IS{negated} NULL"
+        if isinstance(condition, In):
+            params = ", ".join("?" for _ in condition.values)
+            return f"`{condition.column.name}` IN ({params})"
+        if isinstance(condition, Match):
+            # Unlike LIKE, GLOB is case sensitive like str methods
+            return f"`{condition.column.name}` GLOB ?"
+        if isinstance(condition, (And, Or)):
+            operator = " AND " if isinstance(condition, And) else " OR "
+            return "(" + operator.join(
+                self._condition_sql(term) for term in condition.terms
+            ) + ")"
+        if isinstance(condition, Not):
+            return f"NOT {self._condition_sql(condition.term)}"
+        raise TypeError(f"Can't translate {condition!r} to SQL")
+
+    def _condition_params(self, condition, params: list) -> list:
+        if isinstance(condition, Comparison):
+            params.append(condition.value)
+        elif isinstance(condition, In):
+            params.extend(condition.values)
+        elif isinstance(condition, Match):
+            part = "".join(
+                f"[{char}]" if char in "*?[" else char
+                for char in condition.part
+            )
+            params.append({
+                "startswith": f"{part}*",
+                "endswith": f"*{part}",
+            }.get(condition.kind, f"*{part}*"))
+        elif isinstance(condition, (And, Or)):
+            for term in condition.terms:
+                self._condition_params(term, params)
+        elif isinstance(condition, Not):
+            self._condition_params(condition.term, params)
+        return params
+
+    def _select_params(self, query: Query):
+        params = []
+        if query.where is not None:
+            self._condition_params(query.where, params)
+        if query.limit is not None:
+            params.append(query.limit)
+        if query.offset:
+            params.append(query.offset)
+        return params
+
+    def _chunked(self, query: Query, reserved=0):
+        """Splits queries choosing from more values than SQLite allows
+        variables into several ones, see `_merged`. `reserved` variables
+        are needed by the statement besides the query.
+
+        Only values chosen from at the top level of the condition can be
+        split. They are padded to powers of two by repeating the last one,
+        so only a few statement shapes need to be prepared.
+        """
+        condition = query.where
+        terms = condition.terms if isinstance(condition, And) else (condition,)
+        choices = [term for term in terms if isinstance(term, In)]
+        if not choices:
+            yield query
+            return
+        if not all(term.values for term in choices):
+            return  # Nothing can match an empty choice
+        largest = max(choices, key=lambda term: len(term.values))
+        # Unique values, so no row is found by several chunks
+        values = tuple(dict.fromkeys(largest.values))
+        available = self.max_variables - reserved - (
+            len(self._select_params(query)) - len(largest.values)
+        )
+        size = 1 << (max(available, 1).bit_length() - 1)
+        if len(values) > size:
+            # Chunks are paged together after merging their rows, while a
+            # single one is paged like the query
+            query = _unpaged(query)
+        for start in range(0, len(values), size):
+            chunk = values[start:start + size]
+            padded = 1 << (len(chunk) - 1).bit_length()
+            chunk += chunk[-1:] * (padded - len(chunk))
+            chunk = replace(largest, values=chunk)
+            if condition is largest:
+                yield replace(query, where=chunk)
+            else:
+                yield replace(query, where=And(tuple(
+                    chunk if term is largest else term for term in terms
+                )))
+
+    def _insert_sql(self, model_cls: Type[Model]):
+        key = (model_cls, "insert")
+        sql = self._statements.get(key)
+        if sql is None:
+            meta = model_cls._meta
+            columns = ", ".join(f"`{name}`" for name in meta.fields)
+            params = ", ".join("?" for _ in meta.fields)
+            sql = self._statements[key] = "\n".join((
+                f"INSERT INTO `{meta.table}` ({columns})",
+                f"VALUES ({params})",
+            ))
+        return sql
+
+    def _update_sql(self, model_cls: Type[Model], attrs: tuple):
+        key = (model_cls, "update", attrs)
+        sql = self._statements.get(key)
+        if sql is None:
+            sql = self._statements[key] = "\n".join((
+                f"UPDATE `{model_cls._meta.table}`",
+                "SET " + ", ".join(f"`{attr}` = ?" for attr in attrs),
+                "WHERE `id` = ?",
+            ))
+        return sql
+
+    def _where_sql(self, model_cls: Type[Model], op: str, condition, names=()):
+        """UPDATE, setting the names, or DELETE statement for the rows
+        matching the condition, returning their ids."""
+        key = (
+            model_cls, op, None if condition is None else condition.shape(),
+            names,
+        )
+        sql = self._statements.get(key)
+        if sql is None:
+            table = model_cls._meta.table
+            sql = self._statements[key] = "\n".join(filter(None, (
+                f"UPDATE `{table}`" if op == "update" else
+                f"DELETE FROM `{table}`",
+                "SET " + ", ".join(f"`{name}` = ?" for name in names)
+                if names else "",
+                "" if condition is None else
+                f"WHERE {self._condition_sql(condition)}",
+                "RETURNING `id`",
+            )))
+        return sql
+
+    def select(self, model_cls: Type[Model], query: Query, batch_size=1000):
+        chunks = list(self._chunked(query))
+        if len(chunks) == 1:
+            return self._rows(model_cls, chunks[0], batch_size)
+        return self._merged(model_cls, query, chunks, batch_size)
+
+    def _rows(self, model_cls: Type[Model], query: Query, batch_size):
+        return self._fetched(
+            model_cls, self._select_sql(model_cls, query),
+            self._select_params(query), batch_size
+        )
+
+    def _fetched(self, model_cls: Type[Model], sql, params, batch_size):
+        """Rows of a select, read in batches."""
+        if self._listeners is not None:
+            yield from self._observed_rows(model_cls, sql, params, batch_size)
+            return
+        cursor = self._cursor(self._reader().execute, sql, params)
         try:
-            self.cur.execute(
-                f"CREATE TABLE `{table}`{str(tuple(attrs))}"
+            while rows := cursor.fetchmany(batch_size):
+                yield from rows
+        finally:
+            cursor.close()
+
+    def _observed_rows(self, model_cls: Type[Model], sql, params, batch_size):
+        """Like _fetched, telling listeners how many rows were read and how
+        long the database took for them, without the time in between."""
+        execution = self._before_execute(sql, params, model_cls)
+        start = perf_counter()
+        cursor = self._cursor(self._reader().execute, sql, params)
+        duration = perf_counter() - start
+        count = 0
+        try:
+            while True:
+                start = perf_counter()
+                rows = cursor.fetchmany(batch_size)
+                duration += perf_counter() - start
+                if not rows:
+                    break
+                count += len(rows)
+                yield from rows
+        finally:
+            cursor.close()
+            self._after_execute(execution, count, duration)
+
+    def select_members(
+        self, model_cls: Type[Model], name: str, owner_ids, batch_size=1000
+    ):
+        query = Query(Column(model_cls, "id").in_(owner_ids))
+        for chunk in self._chunked(query):
+            yield from self._fetched(
+                model_cls, self._members_sql(model_cls, name, chunk.where),
+                self._select_params(chunk), batch_size
             )
-        except OperationalError:
-            pass  # Table already exists
-
-    def save(self, model: Model):
-        table = model.table_name
-        attrs = list(model.fields().keys())
-        if model._in_db:
-            attrs.remove("id")
-        data = [getattr(model, attr) for attr in attrs]
-        data = [
-            value.id if isinstance(value, Model) else value
-            for value in data
-        ]
-        # Converting
-        data = [
-            self._serealize_type(value)
-            for value in data
-        ]
-        if model._in_db:
-            sql = "\n".join((
-                f"UPDATE `{table}`",
-                "SET",
-                " , ".join(
-                    f"`{attr}` = {repr(value)}"
-                    for attr, value in zip(attrs, data)
-                ),
-                f"WHERE id = {repr(str(model.id))}",
+
+    def select_member_ids(
+        self, model_cls: Type[Model], name: str, owner_ids, batch_size=1000
+    ):
+        """Like select_members, with only the stored id of the related
+        instance in the rows, which are read from the join table alone."""
+        query = Query(Column(model_cls, "id").in_(owner_ids))
+        for chunk in self._chunked(query):
+            yield from self._fetched(
+                model_cls, self._member_ids_sql(model_cls, name, chunk.where),
+                self._select_params(chunk), batch_size
+            )
+
+    def _member_ids_sql(self, model_cls: Type[Model], name: str, condition):
+        key = (model_cls, "member_ids", name, condition.shape())
+        sql = self._statements.get(key)
+        if sql is None:
+            join = model_cls._meta.join_tables[name]
+            params = ", ".join("?" for _ in condition.values)
+            sql = self._statements[key] = "\n".join((
+                f"SELECT `{join.member_column}`, `{join.owner_column}`",
+                f"FROM `{join.name}`",
+                f"WHERE `{join.owner_column}` IN ({params})",
             ))
-        else:
-            sql = "\n".join((
-                f"INSERT INTO `{table}`",
-                f"VALUES {tuple(data)}"
+        return sql
+
+    def _members_sql(self, model_cls: Type[Model], name: str, condition):
+        key = (model_cls, "members", name, condition.shape())
+        sql = self._statements.get(key)
+        if sql is None:
+            meta = model_cls._meta
+            join = meta.join_tables[name]
+            target = meta.collection_targets[name]._meta
+            columns = ", ".join(f"t.`{field}`" for field in target.fields)
+            params = ", ".join("?" for _ in condition.values)
+            sql = self._statements[key] = "\n".join((
+                f"SELECT {columns}, j.`{join.owner_column}`",
+                f"FROM `{join.name}` AS j",
+                f"JOIN `{target.table}` AS t "
+                f"ON t.`id` = j.`{join.member_column}`",
+                f"WHERE j.`{join.owner_column}` IN ({params})",
             ))
-        sql = sql.replace("None", "NULL")
-        self.cur.execute(sql)
-        self.con.commit()
+        return sql
+
+    def _merged(self, model_cls: Type[Model], query: Query, chunks, batch_size):
+        """Rows of the chunks of a query, sorted and paged like the rows
+        of the query itself would be."""
+        columns, selected = _selected(model_cls, query)
+        if query.order_by:
+            chunks = [replace(chunk, columns=selected) for chunk in chunks]
+        rows = [self._rows(model_cls, chunk, batch_size) for chunk in chunks]
+        return _merge(query, columns, selected, rows)
+
+    def count(self, model_cls: Type[Model], query: Query) -> int:
+        chunks = list(self._chunked(query))
+        if len(chunks) > 1 and (query.limit is not None or query.offset):
+            return sum(1 for _ in self._merged(model_cls, query, chunks, 1000))
+        total = 0
+        con = self._reader()
+        for query_ in chunks:
+            rows = self._execute(
+                con,
+                self._select_sql(model_cls, query_, count=True),
+                self._select_params(query_),
+                model_cls,
+            )
+            total += rows[0][0]
+        return total
+
+    def create(self, model: Type[Model]):
+        meta = model._meta
+        self._codec(model)
+        self._models.setdefault(meta.table, []).append(model)
+        columns = []
+        for name in meta.fields:
+            column = f"`{name}` {self._column_type(model, name)}".rstrip()
+            if name == "id":
+                column += " PRIMARY KEY"
+            columns.append(column)
+        statements = ["\n".join((
+            f"CREATE TABLE IF NOT EXISTS `{meta.table}` (",
+            ",\n".join(f"    {column}" for column in columns),
+            ") WITHOUT ROWID" if meta.without_rowid else ")",
+        ))]
+        for name, field in meta.fields.items():
+            if name == "id":
+                continue
+            if field.unique:
+                kind = "UNIQUE INDEX"
+            elif field.index or name in meta.relations:
+                # Relations are indexed for loading collections
+                kind = "INDEX"
+            else:
+                continue
+            statements.append(
+                f"CREATE {kind} IF NOT EXISTS `{meta.table}_{name}_idx` "
+                f"ON `{meta.table}` (`{name}`)"
+            )
+        # Tables created now, whose changes are counted
+        tables = [meta.table]
+        for name, join in meta.join_tables.items():
+            self._models.setdefault(join.name, []).append(model)
+            target = meta.collection_targets[name]
+            if not target._meta.is_resolved:
+                # Created with the other model once its id type is known
+                continue
+            types = {
+                join.owner_column: self._column_type(model, "id"),
+                join.member_column: self._column_type(target, "id"),
+            }
+            first, second = join.columns
+            statements.append("\n".join((
+                f"CREATE TABLE IF NOT EXISTS `{join.name}` (",
+                *(
+                    f"    `{column}` {types[column]}".rstrip() + " NOT NULL,"
+                    for column in join.columns
+                ),
+                f"    PRIMARY KEY (`{first}`, `{second}`)",
+                ") WITHOUT ROWID",
+            )))
+            # For loading the collection of the other side
+            statements.append(
+                f"CREATE INDEX IF NOT EXISTS `{join.name}_{second}_idx` "
+                f"ON `{join.name}` (`{second}`, `{first}`)"
+            )
+            tables.append(join.name)
+        if self.check_interval is not None:
+            for table in tables:
+                statements.extend(_counter_sql(table))
+        con = self._begin()
+        try:
+            for sql in statements:
+                self._execute(con, sql, model_cls=model)
+        finally:
+            self.commit()
+
+    def _column_type(self, model: Type[Model], name: str) -> str:
+        """SQLite type of a field, from its type hint."""
+        meta = model._meta
+        if name in meta.relations:
+            return self._column_type(meta.relations[name], "id")
+        hint = meta.type_hints[name]
+        if not isinstance(hint, type):
+            return ""
+        if issubclass(hint, Enum):
+            values = {type(member.value) for member in hint}
+            if values <= {int, bool}:
+                return "INTEGER"
+            return "TEXT" if values == {str} else ""
+        for types, column_type in _COLUMN_TYPES:
+            if issubclass(hint, types):
+                return column_type
+        return ""
+
+    def explain(self, model_cls: Type[Model], query: Query) -> list[str]:
+        """How SQLite executes the query, to check indexes are used."""
+        query = next(self._chunked(query), query)
+        rows = self._execute(
+            self._reader(),
+            "EXPLAIN QUERY PLAN " + self._select_sql(model_cls, query),
+            self._select_params(query),
+            model_cls,
+        )
+        return [row[-1] for row in rows]
+
+    def decoder(self, model_cls: Type[Model]):
+        return self._codec(model_cls).decode
+
+    def _codec(self, model_cls: Type[Model]) -> Codec:
+        codec = self._codecs.get(model_cls)
+        if codec is None:
+            fields = model_cls._meta.fields
+            codec = self._codecs[model_cls] = Codec(
+                model_cls,
+                {name: self._decoder(model_cls, name) for name in fields},
+                {name: self._encoder(model_cls, name) for name in fields},
+            )
+        return codec
+
+    def _decoder(self, model_cls: Type[Model], name: str):
+        """Converter from a stored value to the field's type, or None if
+        SQLite already returns that type."""
+        meta = model_cls._meta
+        if name in meta.relations:
+            return self._decoder(meta.relations[name], "id")
+        hint = meta.type_hints[name]
+        if hint in (str, int, float, bytes):
+            return None
+        if hint in (bool, UUID):
+            return hint
+        if hint is datetime:
+            return datetime.fromtimestamp
+        if isinstance(hint, type) and issubclass(hint, Enum):
+            return hint
+        return meta.converters[name]
+
+    def _encoder(self, model_cls: Type[Model], name: str):
+        """Converter from a field value to how it is stored, or None if
+        SQLite stores it as is."""
+        meta = model_cls._meta
+        if name in meta.relations:
+            return _relation_encoder(
+                self._encoder(meta.relations[name], "id")
+            )
+        hint = meta.type_hints[name]
+        if hint in (str, int, float, bool, bytes):
+            return None
+        if hint is UUID:
+            return str
+        if hint is datetime:
+            return datetime.timestamp
+        if isinstance(hint, type) and issubclass(hint, Enum):
+            return attrgetter("value")
+        return self._serealize_type
+
+    def insert(self, model_cls: Type[Model], instances):
+        encode = self._codec(model_cls).encoder(tuple(model_cls._meta.fields))
+        self._executemany(
+            self._insert_sql(model_cls),
+            [encode(instance) for instance in instances],
+            model_cls,
+        )
+
+    def update(self, model_cls: Type[Model], instances):
+        # One statement per combination of changed fields
+        by_attrs = {}
+        for instance in instances:
+            attrs = tuple(
+                attr for attr in model_cls._meta.fields
+                if attr in instance._changes
+            )
+            if attrs:
+                by_attrs.setdefault(attrs, []).append(instance)
+        codec = self._codec(model_cls)
+        for attrs, instances_ in by_attrs.items():
+            # The id last, for the WHERE clause
+            encode = codec.encoder(attrs + ("id",))
+            self._executemany(
+                self._update_sql(model_cls, attrs),
+                [encode(instance) for instance in instances_],
+                model_cls,
+            )
+
+    def write_members(self, model_cls: Type[Model], name: str, added, removed):
+        meta = model_cls._meta
+        join = meta.join_tables[name]
+        encode_owner = self._codec(model_cls).encoder(("id",))
+        encode_member = self._codec(
+            meta.collection_targets[name]
+        ).encoder(("id",))
+        for pairs, op in ((removed, "delete"), (added, "insert")):
+            if not pairs:
+                continue
+            self._executemany(
+                self._member_sql(join, op),
+                [
+                    encode_owner(owner) + encode_member(member)
+                    for owner, member in pairs
+                ],
+                model_cls,
+            )
+
+    def _member_sql(self, join, op: str):
+        key = (join.name, op, join.owner_column)
+        sql = self._statements.get(key)
+        if sql is None:
+            owner, member = join.owner_column, join.member_column
+            if op == "insert":
+                # The pair may be in the table already, if it was added to
+                # a collection which wasn't loaded
+                sql = "\n".join((
+                    f"INSERT OR IGNORE INTO `{join.name}` "
+                    f"(`{owner}`, `{member}`)",
+                    "VALUES (?, ?)",
+                ))
+            else:
+                sql = "\n".join((
+                    f"DELETE FROM `{join.name}`",
+                    f"WHERE `{owner}` = ? AND `{member}` = ?",
+                ))
+            self._statements[key] = sql
+        return sql
+
+    def update_where(self, model_cls: Type[Model], query: Query, values):
+        codec = self._codec(model_cls)
+        names = tuple(values)
+        params = [codec.encode_value(name, values[name]) for name in names]
+        return self._write_where(model_cls, query, "update", names, params)
+
+    def delete_where(self, model_cls: Type[Model], query: Query):
+        return self._write_where(model_cls, query, "delete", (), [])
+
+    def _write_where(self, model_cls, query, op, names, params) -> list:
+        if query.order_by or query.limit is not None or query.offset:
+            # SQLite is rarely built to allow these in UPDATE and DELETE,
+            # so the rows are chosen by their ids instead
+            ids = [
+                row[0] for row in
+                self.select(model_cls, replace(query, columns=("id",)))
+            ]
+            query = Query(Column(model_cls, "id").in_(ids))
+        con = self._begin()
+        ids = {}
+        for chunk in self._chunked(query, len(params)):
+            rows = self._execute(
+                con, self._where_sql(model_cls, op, chunk.where, names),
+                params + self._select_params(chunk), model_cls,
+            )
+            # Rows can be matched by several chunks if their values change
+            ids.update(dict.fromkeys(row[0] for row in rows))
+        if op == "delete" and ids:
+            self._delete_members(con, model_cls, list(ids))
+        return list(ids)
+
+    def _delete_members(self, con, model_cls: Type[Model], ids):
+        """Deletes the rows of deleted instances from their join tables."""
+        for join in model_cls._meta.join_tables.values():
+            query = Query(In(Column(model_cls, "id"), tuple(ids)))
+            for chunk in self._chunked(query):
+                key = (
+                    join.name, "delete", join.owner_column,
+                    len(chunk.where.values),
+                )
+                sql = self._statements.get(key)
+                if sql is None:
+                    params = ", ".join("?" for _ in chunk.where.values)
+                    sql = self._statements[key] = "\n".join((
+                        f"DELETE FROM `{join.name}`",
+                        f"WHERE `{join.owner_column}` IN ({params})",
+                    ))
+                self._execute(con, sql, chunk.where.values, model_cls)
+
+    def commit(self):
+        if self._writer == get_ident():
+            try:
+                self.con.commit()
+                self._committed()
+            finally:
+                self._end()
+
+    def rollback(self):
+        if self._writer == get_ident():
+            try:
+                self.con.rollback()
+            finally:
+                self._end()
+
+
+_CHANGES_TABLE_SQL = """CREATE TABLE IF NOT EXISTS `dcorm_changes` (
+    `table` TEXT PRIMARY KEY,
+    `version` INTEGER NOT NULL
+) WITHOUT ROWID"""
+_CHANGES_SQL = "SELECT `table`, `version` FROM `dcorm_changes`"
+
+
+def _counter_sql(table) -> list:
+    """Statements counting the changes to a table in dcorm_changes."""
+    statements = [
+        f"INSERT OR IGNORE INTO `dcorm_changes` VALUES ('{table}', 0)"
+    ]
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        statements.append("\n".join((
+            f"CREATE TRIGGER IF NOT EXISTS "
+            f"`{table}_dcorm_{event.lower()}` AFTER {event} ON `{table}`",
+            "BEGIN",
+            "    UPDATE `dcorm_changes` SET `version` = `version` + 1",
+            f"    WHERE `table` = '{table}';",
+            "END",
+        )))
+    return statements
+
+
+def _unpaged(query: Query) -> Query:
+    """Query for one of several parts of a query, whose rows are paged
+    together after merging them, see `_merge`."""
+    if query.limit is not None:
+        query = replace(query, limit=query.limit + query.offset)
+    return replace(query, offset=0)
+
+
+def _selected(model_cls: Type[Model], query: Query) -> tuple:
+    """Columns of the query and the ones to select in its parts, which
+    include the columns needed to sort the rows of all parts."""
+    columns = query.columns or tuple(model_cls._meta.fields)
+    if not query.order_by:
+        return columns, columns
+    return columns, tuple(dict.fromkeys(
+        columns + tuple(name for name, _ in query.order_by)
+    ))
+
+
+def _merge(query: Query, columns, selected, rows):
+    """Rows of the parts of a query, iterators of rows of the selected
+    columns, sorted and paged like the rows of the query itself would
+    be, with its columns."""
+    if query.order_by:
+        index = {name: i for i, name in enumerate(selected)}
+        rows = merge(*rows, key=sort_key(
+            query.order_by, lambda row, name: row[index[name]]
+        ))
+    else:
+        rows = chain(*rows)
+    if query.limit is not None or query.offset:
+        stop = None if query.limit is None else query.offset + query.limit
+        rows = islice(rows, query.offset, stop)
+    if selected is columns:
+        yield from rows
+    else:
+        for row in rows:
+            yield row[:len(columns)]
+
+
+def _relation_encoder(encode_id):
+    def encode(value):
+        if isinstance(value, Model):
+            value = value.id
+        if value is None or encode_id is None:
+            return value
+        return encode_id(value)
+    return encode
+
+
+_COLUMN_TYPES = (
+    ((int,), "INTEGER"),  # Including bool
+    ((float, datetime), "REAL"),
+    ((str, UUID), "TEXT"),
+    ((bytes,), "BLOB"),
+)
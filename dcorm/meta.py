@@ -0,0 +1,217 @@
+from dataclasses import dataclass
+from datetime import datetime
+from functools import cached_property
+from types import MappingProxyType
+from typing import (
+    Any, Callable, ForwardRef, Mapping, get_args, get_type_hints
+)
+
+from dcorm.fields import Field, Collection
+from dcorm.storage import field_values
+
+
+@dataclass(frozen=True)
+class JoinTable:
+    """Table of a many-to-many relationship, seen from one collection.
+
+    It has a row per pair of related instances, with the id of the
+    instance holding the collection in `owner_column` and the one of the
+    instance in it in `member_column`. The columns are named after the
+    collections the ids are members of. The pair of columns of the owning
+    side, whose collection writes the rows, is the primary key.
+    """
+    name: str
+    owner_column: str
+    member_column: str
+    owning: bool
+
+    @property
+    def columns(self) -> tuple[str, str]:
+        """The columns in the order of the primary key."""
+        if self.owning:
+            return self.owner_column, self.member_column
+        return self.member_column, self.owner_column
+
+
+@dataclass(frozen=True, eq=False)
+class ModelMeta:
+    """Everything the ORM needs to know about a registered model.
+
+    The ordered field and collection maps are collected once at
+    registration. Type hints and everything derived from them are
+    resolved lazily, because a model may reference other models that
+    are not registered yet (forward references such as `'Class'`).
+    """
+    model: type
+    table: str
+    fields: Mapping[str, Field]
+    collections: Mapping[str, Collection]
+    without_rowid: bool = False
+    # Type of the field values of each instance, see register
+    values: type = dict
+
+    @classmethod
+    def build(cls, model, without_rowid=False, compact=False):
+        fields = {}
+        collections = {}
+        for cls_ in model.mro()[::-1]:
+            for key, value in cls_.__dict__.items():
+                if isinstance(value, Field):
+                    fields[key] = value
+                elif isinstance(value, Collection):
+                    collections[key] = value
+        return cls(
+            model=model,
+            table=model.__name__.lower(),
+            fields=MappingProxyType(fields),
+            collections=MappingProxyType(collections),
+            without_rowid=without_rowid,
+            values=(
+                field_values(model, [*fields, *collections])
+                if compact else dict
+            ),
+        )
+
+    @property
+    def is_resolved(self) -> bool:
+        return "converters" in self.__dict__
+
+    def resolve(self) -> bool:
+        """Try to resolve all forward references, returns success."""
+        try:
+            self.converters
+        except NameError:
+            return False
+        return True
+
+    @cached_property
+    def type_hints(self) -> Mapping[str, Any]:
+        from dcorm import Model
+
+        return MappingProxyType(
+            get_type_hints(self.model, localns=Model._model_clss)
+        )
+
+    @cached_property
+    def relations(self) -> Mapping[str, type]:
+        """Fields pointing to another model, mapped to that model."""
+        from dcorm import Model
+
+        return MappingProxyType({
+            name: hint
+            for name, hint in self.type_hints.items()
+            if name in self.fields
+            and isinstance(hint, type) and issubclass(hint, Model)
+        })
+
+    @cached_property
+    def collection_targets(self) -> Mapping[str, type]:
+        """Collections mapped to the model they contain."""
+        from dcorm import Model
+
+        targets = {}
+        for name in self.collections:
+            target = get_args(self.type_hints[name])[0]
+            if isinstance(target, ForwardRef):
+                target = target.__forward_arg__
+            if isinstance(target, str):
+                try:
+                    target = Model._model_clss[target]
+                except KeyError:
+                    raise NameError(f"{target} is not defined") from None
+            targets[name] = target
+        return MappingProxyType(targets)
+
+    @cached_property
+    def join_tables(self) -> Mapping[str, JoinTable]:
+        """Many-to-many collections, mapped to their join table."""
+        join_tables = {}
+        for name, target in self.collection_targets.items():
+            target_meta = target.__dict__.get("_meta")
+            if target_meta is None:
+                raise NameError(f"{target.__name__} is not registered")
+            backref = self.collections[name].backref
+            if backref not in target_meta.collections:
+                continue
+            if target._db is not self.model._db:
+                raise ValueError(
+                    f"{self.model.__name__}.{name} needs to be in the same "
+                    "database as its backref"
+                )
+            side = (self.table, name)
+            other_side = (target_meta.table, backref)
+            if side == other_side:
+                raise ValueError(
+                    f"{self.model.__name__}.{name} can't be its own backref"
+                )
+            owning = side < other_side
+            table, collection = side if owning else other_side
+            join_tables[name] = JoinTable(
+                f"{table}_{collection}", backref, name, owning
+            )
+        return MappingProxyType(join_tables)
+
+    @cached_property
+    def converters(self) -> Mapping[str, Callable[[Any], Any]]:
+        """Per field functions turning raw values into the hinted type."""
+        converters = {}
+        for name in self.fields:
+            hint = self.type_hints[name]
+            if name in self.relations:
+                target = self.relations[name]
+                target_meta = target.__dict__.get("_meta")
+                if target_meta is None:
+                    raise NameError(f"{target.__name__} is not registered")
+                id_hint = target_meta.type_hints["id"]
+                converters[name] = _relation_converter(id_hint)
+            else:
+                converters[name] = _value_converter(hint)
+        # Only cache once all relations resolved as well
+        self.join_tables
+        return MappingProxyType(converters)
+
+
+def _relation_converter(id_hint):
+    from dcorm import Model
+
+    def convert(value):
+        if value is None or isinstance(value, Model):
+            # Relationship is already set
+            return value
+        if type(value) is not id_hint:
+            # Only the id is known, the related instance is loaded when
+            # the field is read, see Field._load, or by prefetch
+            return id_hint(value)
+        return value
+    return convert
+
+
+def _value_converter(hint):
+    if not isinstance(hint, type):
+        return _identity
+    if issubclass(hint, datetime):
+        def convert(value):
+            if value is None or type(value) is hint:
+                return value
+            return hint.fromtimestamp(value)
+    else:
+        def convert(value):
+            if value is None or type(value) is hint:
+                return value
+            return hint(value)
+    return convert
+
+
+def _identity(value):
+    return value
+
+
+def resolve_pending(model_clss) -> list:
+    """Resolve the metadata of every registered model that can be,
+    returns the models resolved now."""
+    resolved = []
+    for model in model_clss.values():
+        meta = model.__dict__.get("_meta")
+        if meta is not None and not meta.is_resolved and meta.resolve():
+            resolved.append(model)
+    return resolved
@@ -1,35 +1,58 @@
 from copy import deepcopy
-from dataclasses import _process_class
-from typing import get_type_hints, get_args, Any
+from dataclasses import dataclass, replace
+from typing import Any
 
-from dcorm import Field, Collection
+from dcorm import Collection
+from dcorm.cache import IdentityMap
 from dcorm.mappers.base import Mapper
+from dcorm.meta import ModelMeta, resolve_pending
+from dcorm.expressions import Column, ordering, where
+from dcorm.fields import NOLOAD, _key
+from dcorm.instrumentation import ModelStats
+from dcorm.query import Query, QuerySet
+from dcorm.session import Session, current_session
+from dcorm.storage import NO_CHANGES
 
 
 def register(
-    db, *, init=True, repr=True, eq=True,
-    order=False, unsafe_hash=False, frozen=False, match_args=True,
-    kw_only=False, slots=False
+    db, *, cache=None, query_cache=None, without_rowid=False, init=True,
+    repr=True, eq=True, order=False, unsafe_hash=False, frozen=False,
+    match_args=True, kw_only=False, slots=False
 ):
     """Returns the same class as was passed in, with dunder methods
     added based on the fields defined in the class.
 
     Examines PEP 526 __annotations__ to determine fields.
 
+    If cache is given, it is used as the model's identity map instead of
+    the default one that keeps all instances, for example a
+    LRUIdentityMap from dcorm.cache. Each model needs its own.
+
+    If query_cache is given, a QueryCache from dcorm.cache, the ids found
+    by queries of the model are kept in it, so repeated queries don't
+    read the database. Each model needs its own as well.
+
+    If without_rowid is true, SQLite stores the table ordered by id
+    instead of by an extra rowid, which suits ids like UUIDs.
+
     If init is true, an __init__() method is added to the class. If
     repr is true, a __repr__() method is added. If order is true, rich
     comparison dunder methods are added. If unsafe_hash is true, a
     __hash__() method function is added. If frozen is true, fields may
     not be assigned to after instance creation. If match_args is true,
     the __match_args__ tuple is added. If kw_only is true, then by
-    default all fields are keyword-only. If slots is true, an
-    __slots__ attribute is added.
+    default all fields are keyword-only.
+
+    If slots is true, instances are compact: they have no __dict__ and
+    keep their field values in slots instead of a dict, which takes
+    much less memory per instance. Classes between Model and the model
+    need `__slots__ = ()` for this as well.
     """
 
     def wrap(cls):
         return _register(
-            cls, db, init, repr, eq, order, unsafe_hash,
-            frozen, match_args, kw_only, slots
+            cls, db, cache, query_cache, without_rowid, init, repr, eq, order,
+            unsafe_hash, frozen, match_args, kw_only, slots
         )
 
     if not isinstance(db, Mapper):
@@ -40,144 +63,218 @@ def register(
 
 
 class Model:
+    __slots__ = ()  # Allows compact models, see register
     _db = None  # Set by register decorator
+    _meta = None  # Set by register decorator
+    _query_cache = None  # Set by register decorator, if any
     _model_clss = {}  # All registered model classes
     _has_unsaved_changes = False
+    _in_db = False
+    savable = True
 
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
-        cls._cache = list()
-        cls._in_db = False
-        cls.savable = True
+        cls._cache = IdentityMap()
+        cls._stats = ModelStats()
         cls._model_clss[cls.__name__] = cls
         return cls
 
     def __post_init__(self):
-        self._cache.append(self)
-        for attr, type_hint in self.type_hints.items():
+        self._cache.add(self)
+        for attr in self._meta.collections:
             value = getattr(self, attr)
-            is_field = attr in self.fields()
-            if value is not None and is_field:
-                is_set = isinstance(value, type_hint)
-                # is_set is inside this if, because it will raise erros if type
-                # hint is something like list[Model]
-                if not is_set and issubclass(type_hint, Model) and type_hint._db:
-                    # Load relationship
-                    relation = getattr(self, attr)
-                    if getattr(relation, "id", None) is not value:
-                        # Only set if it's not set already
-                        relation = type_hint.get(id=value)
-                        setattr(self, attr, relation)
-            elif isinstance(value, Collection):
-                value = deepcopy(value)
-                setattr(self, attr, value)
-                value.model = self
-                # Load relationships
-                th = get_args(type_hint)[0]
-                if isinstance(th, str):
-                    # Convert it to object
-                    th = self._model_clss[th]
-                filters = {value.backref: self.id}
-                # Adding the relationships found to the collection is automatic
-                # through the relation finding of the related field
-                for rel in th.find(**filters):
-                    if rel not in value:
-                        value.append(rel)
+            if isinstance(value, Collection):
+                # Related instances are only loaded once accessed
+                setattr(self, attr, value._bind(self))
 
     @classmethod
     def from_json(cls, **data):
+        if "id" in data:
+            instance = cls._cache.peek(cls._typed_id(data["id"]))
+            if instance is not None:
+                return instance
         return cls(**data)
 
+    @classmethod
+    def _typed_id(cls, value):
+        return cls._meta.converters["id"](value)
+
+    @classmethod
+    def _cached(cls, query=None, **filters):
+        """Instances in the identity map matching the condition and all
+        filters."""
+        cls._db.sync()
+        if "id" in filters:
+            instance = cls._cache.get(cls._typed_id(filters["id"]))
+            candidates = () if instance is None else (instance,)
+        else:
+            candidates = cls._cache
+        condition = where(cls, query, **filters)
+        for instance in candidates:
+            if condition is None or condition.matches(instance):
+                yield instance
+
     @classmethod
     def fields(cls) -> dict[str, Any]:
-        return {
-            key: value
-            for cls_ in cls.mro()[::-1]
-            for key, value in cls_.__dict__.items()
-            if isinstance(value, Field)
-        }
+        return cls._meta.fields
 
     @classmethod
     def collections(cls) -> dict[str, Any]:
-        return {
-            key: value
-            for cls_ in cls.mro()[::-1]
-            for key, value in cls_.__dict__.items()
-            if isinstance(value, Collection)
-        }
+        return cls._meta.collections
 
     @classmethod
-    def find(cls, query=None, **filters):
-        if query:
-            raise NotImplementedError(
-                "Function-like queries are not supported yet!"
-            )
-
-        instances_found = {}
-        for instance in cls._cache:
-            for key, value in filters.items():
-                if getattr(instance, key) != value:
-                    break
-            else:
-                instances_found[str(instance.id)] = instance
+    def find(
+        cls, query=None, prefetch=(), *, order_by=(), limit=None, offset=0,
+        **filters
+    ) -> QuerySet:
+        """All instances matching the condition and filters, loaded lazily.
 
-        raw_instances = cls._db.find(cls, query, **filters)
-        for data in raw_instances:
-            if data["id"] not in instances_found:
-                instance = cls.from_json(**data)
-                instance._in_db = True
-                instances_found[data["id"]] = instance
-        return list(instances_found.values())
+        The condition is built from the fields of the model, for example
+        `User.name.startswith("B") & (User.age >= 18)`. The instances are
+        sorted by the fields in order_by, prefixed with "-" for descending
+        order. The relations named in prefetch are loaded in bulk, see
+        QuerySet.
+        """
+        return QuerySet(cls, Query(
+            where(cls, query, **filters), ordering(cls, order_by), limit,
+            offset
+        ), prefetch)
 
     @classmethod
     def get(cls, query=None, **filters):
-        if query:
-            raise NotImplementedError(
-                "Function-like queries are not supported yet!"
-            )
-
-        for instance in cls._cache:
-            for key, value in filters.items():
-                if getattr(instance, key) != value:
-                    break
-            else:
-                return instance
+        """An instance matching the condition and filters, or None."""
+        for instance in cls._cached(query, **filters):
+            return instance
+        return cls.find(query, **filters).first()
+
+    @classmethod
+    async def aget(cls, query=None, **filters):
+        """Like get, reading from the database without blocking the
+        event loop if the mapper supports it."""
+        for instance in cls._cached(query, **filters):
+            return instance
+        return await cls._db.read(cls.find(query, **filters).first)
 
-        # ToDo: get data and load it with cls.from_json
-        return cls._db.get(cls, query, **filters)
+    @classmethod
+    def afind(cls, query=None, prefetch=(), **kwargs) -> QuerySet:
+        """Like find, for `async for`, which reads each batch without
+        blocking the event loop if the mapper supports it."""
+        return cls.find(query, prefetch, **kwargs)
 
     @classmethod
-    def all(cls):
+    def all(cls) -> QuerySet:
         """All instances of this model."""
         return cls.find()
 
+    @classmethod
+    def pre_load(cls):
+        """Loads all instances of this model and keeps them cached."""
+        instances = list(cls.all())
+        for instance in instances:
+            cls._cache.pin(instance)
+        return instances
+
+    @classmethod
+    def cache_info(cls):
+        """Hits, misses, evictions and size of the model's cache."""
+        return cls._cache.info()
+
+    @classmethod
+    def expire(cls):
+        """Forgets the cached state of the model's rows, for example after
+        other programs wrote them.
+
+        Instances without unsaved changes are dropped from the cache and
+        loaded again when needed. Pinned ones are loaded again right
+        away instead, and query results are dropped.
+        """
+        kept = cls._cache.expire()
+        if cls._query_cache is not None:
+            cls._query_cache.invalidate()
+        if not kept:
+            return
+        by_id = {instance.id: instance for instance in kept}
+        converters = cls._meta.converters
+        fields = tuple(cls._meta.fields)
+        query = Query(Column(cls, "id").in_(by_id))
+        for row in cls._db.select(cls, query):
+            values = {
+                name: converters[name](value)
+                for name, value in zip(fields, row)
+            }
+            by_id.pop(values["id"])._updated(values)
+        # Deleted by another program
+        held = _held(cls, by_id.values())
+        for instance in by_id.values():
+            instance._deleted(held)
+
+    @classmethod
+    def query_cache_info(cls):
+        """Hits, misses, evictions and size of the model's query cache,
+        or None without one."""
+        if cls._query_cache is None:
+            return None
+        return cls._query_cache.info()
+
+    @classmethod
+    def stats(cls) -> ModelStats:
+        """Cache hits and misses, hydrations and rows written so far."""
+        cache_stats = cls._cache.stats
+        return replace(
+            cls._stats, hits=cache_stats.hits, misses=cache_stats.misses
+        )
+
     @property
     def table_name(self):
-        return self.__class__.__name__.lower()
+        return self._meta.table
 
     @property
     def relations(self):
-        for cls_ in self.__class__.mro()[::-1]:
-            for key, type_ in cls_.__dict__.items():
-                if isinstance(type_, Field):
-                    type_hints = self.type_hints
-                    if issubclass(type_hints[key], Model):
-                        value = getattr(self, key)
-                        if isinstance(value, Model):
-                            yield value
-                elif isinstance(type_, Collection):
-                    relations = getattr(self, key).relationships
-                    for relation in relations:
-                        yield relation
+        """Related instances which are loaded already."""
+        meta = self._meta
+        for key in meta.relations:
+            value = self._descriptor_values.get(key)
+            if isinstance(value, Model):
+                yield value
+        for key in meta.collections:
+            yield from getattr(self, key).relationships
 
     @property
     def type_hints(self):
-        result = {}
-        for cls in self.__class__.mro():
-            result.update(
-                get_type_hints(cls, self._model_clss)
-            )
-        return result
+        return self._meta.type_hints
+
+    @property
+    def changes(self) -> dict[str, tuple]:
+        """Fields changed since the last load or save, mapped to their
+        original and current value."""
+        return {
+            name: (original, getattr(self, name))
+            for name, original in self._changes.items()
+        }
+
+    def _track_change(self, name, old, new):
+        changes = self._changes
+        if name in changes:
+            if _column_value(changes[name]) == _column_value(new):
+                # Changed back to the value in the database
+                del changes[name]
+                if not changes:
+                    self._mark_clean()
+        elif _column_value(old) != _column_value(new):
+            if changes is NO_CHANGES:
+                changes = self._changes = {}
+            changes[name] = old
+            self._mark_dirty()
+
+    def _mark_dirty(self):
+        if not self._has_unsaved_changes:
+            self._has_unsaved_changes = True
+            self._cache.mark_dirty(self)
+
+    def _mark_clean(self):
+        if self._has_unsaved_changes:
+            self._has_unsaved_changes = False
+            self._cache.mark_clean(self)
 
     def clone(self, savable=False):
         """Creates a clone of this model instance."""
@@ -186,33 +283,255 @@ class Model:
         copy.savable = savable
         return copy
 
-    def save(self, *, exclude_ids=None):
-        exclude_ids = exclude_ids or []
-        if self.savable and self.id not in exclude_ids:
-            if self._has_unsaved_changes:
-                self._db.save(self)
-                self._has_unsaved_changes = False
-                self._in_db = True
-            exclude_ids.append(self.id)
-            for relation in self.relations:
-                relation.save(exclude_ids=exclude_ids)
+    def save(self):
+        """Saves this instance and the instances related to it.
+
+        Inside a `with Session()` block, they are only added to that
+        session and written when it flushes.
+        """
+        session = current_session()
+        if session is not None:
+            session.add(self)
+        else:
+            with Session() as session:
+                session.add(self)
+
+        # ToDo: throw error if not savable
+
+    def delete(self):
+        """Deletes the row of this instance.
+
+        The instance is removed from the cache and from the collections
+        holding it. Instances pointing to it keep doing so, like rows do
+        without cascading deletes. Inside a `with Session()` block, this
+        is part of that session's transaction.
+        """
+        if self._in_db:
+            self.__class__.find(id=self.id).delete()
+        if self._in_db:
+            # No longer cached and so unknown to the query set
+            session = current_session()
+            changes = self._changes
+            collections = self._deleted()
+            if session is not None:
+                session._deleted(self, changes, collections)
+        else:
+            self._deleted()
+
+    def _updated(self, values):
+        """Takes over values written to the database directly. Unsaved
+        changes to the same fields are still written when saving."""
+        stored = self._descriptor_values
+        changes = self._changes
+        relations = self._meta.relations
+        for name, value in values.items():
+            if name in changes:
+                if _column_value(stored.get(name)) == _column_value(value):
+                    # The database has the unsaved value now
+                    del changes[name]
+                    if not changes:
+                        self._mark_clean()
+                else:
+                    changes[name] = value
+                continue
+            old = stored.get(name)
+            stored[name] = value
+            if name in relations:
+                for collection in _backrefs(self.__class__, name, old):
+                    collection._discard(self)
+                for collection in _backrefs(self.__class__, name, value):
+                    collection._add(self)
+
+    def _reverted(self, values, changes):
+        """Undoes `_updated` after the update was rolled back, with the
+        values the database had before and the unsaved changes of the
+        same fields then."""
+        self._updated({
+            name: value for name, value in values.items()
+            if name not in changes
+        })
+        if changes:
+            if self._changes is NO_CHANGES:
+                self._changes = {}
+            self._changes.update(changes)
+            self._mark_dirty()
 
-        # ToDo: throw error for else
+    def _deleted(self, held=None) -> list:
+        """Forgets about the row of this instance, which was deleted.
+        Returns the collections it was removed from. held is what `_held`
+        returns for instances including this one, when deleting many."""
+        if held is None:
+            held = _held(self.__class__, (self,))
+        self._cache.discard(self)
+        self._mark_clean()
+        self._in_db = False
+        self._changes = NO_CHANGES
+        values = self._descriptor_values
+        holding = list(held.get(_key(self), ()))
+        for name in self._meta.relations:
+            owner = values.get(name)
+            holding.extend(_backrefs(self.__class__, name, owner))
+        removed = []
+        for collection in holding:
+            if collection._has(self):
+                collection._discard(self)
+                removed.append(collection)
+        return removed
+
+    def _undeleted(self, changes, collections):
+        """Undoes `_deleted` after the delete was rolled back, with the
+        unsaved changes before and the collections it was removed from."""
+        self._cache.add(self)
+        self._in_db = True
+        self._changes = changes
+        if changes:
+            self._mark_dirty()
+        for collection in collections:
+            collection._add(self)
+
+    async def asave(self):
+        """Like save, writing without blocking the event loop if the
+        mapper supports it."""
+        session = current_session()
+        if session is not None:
+            session.add(self)
+        else:
+            async with Session() as session:
+                session.add(self)
+
+
+def _column_value(value):
+    """The value stored in the database for a field value."""
+    if isinstance(value, Model):
+        return value.id
+    return value
+
+
+def _held(model_cls, instances) -> dict:
+    """Many-to-many collections of the other side which hold any of the
+    instances, by the key of the instance in them, found in one pass."""
+    instances = list(instances)
+    held = {}
+    meta = model_cls._meta
+    for name, collection in meta.collections.items():
+        backref = collection.backref
+        target = meta.collection_targets[name]
+        if backref not in target._meta.collections:
+            continue
+        wanted = set()
+        for instance in instances:
+            own = instance._descriptor_values.get(name)
+            if own is not None and own._loaded and own.loading != NOLOAD:
+                # The related instances hold this one as well
+                key = _key(instance)
+                for other in own.relationships:
+                    collection_ = other._descriptor_values.get(backref)
+                    if collection_ is not None:
+                        held.setdefault(key, []).append(collection_)
+            else:
+                wanted.add(_key(instance))
+        if not wanted:
+            continue
+        # Collections of the other side may have been loaded with these
+        # in them, see _load_members
+        for other in target._cache:
+            collection_ = other._descriptor_values.get(backref)
+            if collection_ is None:
+                continue
+            members = collection_._members
+            if len(wanted) < len(members):
+                keys = [key for key in wanted if key in members]
+            else:
+                keys = [key for key in members if key in wanted]
+            for key in keys:
+                held.setdefault(key, []).append(collection_)
+    return held
+
+
+def _backrefs(model_cls, name, owner) -> list:
+    """Collections of the owner an instance of the model is in because
+    its field points to the owner, which may also be an id."""
+    if owner is None:
+        return []
+    if not isinstance(owner, Model):
+        owner = model_cls._meta.relations[name]._cache.peek(owner)
+        if owner is None:
+            return []
+    meta = owner._meta
+    values = owner._descriptor_values
+    return [
+        values[collection_name]
+        for collection_name, collection in meta.collections.items()
+        if collection.backref == name
+        and meta.collection_targets[collection_name] is model_cls
+        and collection_name in values
+    ]
 
 
 def _register(
-    cls, db, init, repr, eq, order, unsafe_hash,
-    frozen, match_args, kw_only, slots
+    cls, db, cache, query_cache, without_rowid, init, repr, eq, order,
+    unsafe_hash, frozen, match_args, kw_only, slots
 ):
-    cls = _process_class(
-        cls, init, repr, eq, order, unsafe_hash,
-        frozen, match_args, kw_only, slots
+    cls = dataclass(
+        cls, init=init, repr=repr, eq=eq, order=order,
+        unsafe_hash=unsafe_hash, frozen=frozen, match_args=match_args,
+        kw_only=kw_only
     )
+    if slots:
+        cls = _compact(cls)
     cls._db = db
+    if cache is not None:
+        cls._cache = cache
+    cls._query_cache = query_cache
+    cls._meta = ModelMeta.build(cls, without_rowid, compact=slots)
+    # Columns are typed, so tables are only created once the models
+    # they refer to are registered
+    for model_cls in resolve_pending(Model._model_clss):
+        model_cls._db.create(model_cls)
     __old_init__ = cls.__init__
-    def __pre_init__(inst, *args, **kwargs):
-        inst._descriptor_values = {}
-        __old_init__(inst, *args, **kwargs)
+    values = cls._meta.values
+    if slots:
+        def __pre_init__(inst, *args, **kwargs):
+            inst._descriptor_values = values()
+            inst._changes = NO_CHANGES
+            inst._in_db = False
+            inst._has_unsaved_changes = False
+            inst.savable = True
+            __old_init__(inst, *args, **kwargs)
+    else:
+        def __pre_init__(inst, *args, **kwargs):
+            inst._descriptor_values = values()
+            inst._changes = NO_CHANGES
+            __old_init__(inst, *args, **kwargs)
     cls.__init__ = __pre_init__
-    db.create(cls)
     return cls
+
+
+# State of each instance of a compact model
+_STATE_SLOTS = (
+    "_descriptor_values", "_changes", "_in_db", "_has_unsaved_changes",
+    "savable", "__weakref__",
+)
+
+
+def _compact(cls):
+    """Recreates the class with slots for the instance state, the way
+    dataclasses does for slots=True, which would replace the fields."""
+    namespace = dict(cls.__dict__)
+    namespace.pop("__dict__", None)
+    namespace.pop("__weakref__", None)
+    namespace["__slots__"] = _STATE_SLOTS
+    new_cls = type(cls)(cls.__name__, cls.__bases__, namespace)
+    # Methods using super() refer to the class they were defined in
+    for value in namespace.values():
+        if isinstance(value, (classmethod, staticmethod)):
+            value = value.__func__
+        elif isinstance(value, property):
+            value = value.fget
+        closure = getattr(value, "__closure__", None)
+        if not closure:
+            continue
+        for name, cell in zip(value.__code__.co_freevars, closure):
+            if name == "__class__" and cell.cell_contents is cls:
+                cell.cell_contents = new_cls
+    return new_cls
@@ -0,0 +1,585 @@
+from dataclasses import dataclass, replace
+from heapq import merge
+from itertools import chain, islice
+from typing import Any, AsyncIterator, Iterator
+
+from dcorm import columns
+from dcorm.expressions import (
+    And, Column, Expression, column, ordering, sort_key, where
+)
+from dcorm.session import Session, current_session
+
+
+@dataclass(frozen=True)
+class Query:
+    """What a mapper should select, independent of the database.
+
+    `where` is the condition rows need to match, `order_by` holds
+    Orderings, and `columns` the fields to read if not all of them are
+    needed.
+    """
+    where: Expression = None
+    order_by: tuple = ()
+    limit: int = None
+    offset: int = 0
+    columns: tuple = None
+
+
+class QuerySet:
+    """Lazy result of `Model.find`.
+
+    Nothing is loaded until the query set is iterated. Rows are then
+    read in batches of `batch_size` and hydrated one at a time. The
+    identity map keeps the instances, so walking a large table only
+    needs as much memory as a batch if the model's map drops them, like
+    WeakIdentityMap or LRUIdentityMap do.
+
+    Instances with unsaved changes are matched with their values in
+    memory instead of the ones in the database, like all cached ones
+    used to be, and merged into the rows in the requested order.
+
+    Relations named in `prefetch` (dotted for nested ones, for example
+    `"users.class_"`) and eagerly loaded ones are loaded for a whole
+    batch at once, with one query per relation.
+
+    With `async for`, each batch is read through the mapper's `read`,
+    which async mappers run without blocking the event loop.
+
+    `update` and `delete` change all matching rows with one statement
+    instead, without loading them.
+    """
+
+    batch_size = 1000
+
+    def __init__(self, model_cls, query: Query, prefetch=()):
+        self.model_cls = model_cls
+        self.query = query
+        self.prefetch_paths = tuple(prefetch)
+
+    def __iter__(self) -> Iterator[Any]:
+        tree = _with_eager(self.model_cls, _prefetch_tree(self.prefetch_paths))
+        if not tree:
+            yield from self._instances()
+            return
+        batch = []
+        for instance in self._instances():
+            batch.append(instance)
+            if len(batch) >= self.batch_size:
+                prefetch(self.model_cls, batch, tree)
+                yield from batch
+                batch = []
+        if batch:
+            prefetch(self.model_cls, batch, tree)
+            yield from batch
+
+    async def __aiter__(self) -> AsyncIterator[Any]:
+        instances = iter(self)
+        read = self.model_cls._db.read
+        while batch := await read(list, islice(instances, self.batch_size)):
+            for instance in batch:
+                yield instance
+
+    def _instances(self) -> Iterator[Any]:
+        model_cls = self.model_cls
+        query = self.query
+        model_cls._db.sync()
+        dirty = model_cls._cache.dirty()
+        if not dirty:
+            yield from self._loaded(query, {})
+            return
+
+        condition = query.where
+        local = {
+            instance.id: instance for instance in dirty
+            if condition is None or condition.matches(instance)
+        }
+        paged = query.limit is not None or query.offset
+        if paged:
+            # Rows of instances with unsaved changes are skipped, so read
+            # enough to make up for them and page after merging
+            limit = query.limit
+            if limit is not None:
+                limit += query.offset + len(dirty)
+            query = replace(query, limit=limit, offset=0)
+
+        loaded = self._loaded(query, local)
+        if query.order_by:
+            key = sort_key(
+                query.order_by,
+                lambda instance, name: Column(model_cls, name).value(instance)
+            )
+            instances = merge(sorted(local.values(), key=key), loaded, key=key)
+        else:
+            instances = chain(local.values(), loaded)
+        if paged:
+            stop = self.query.limit
+            if stop is not None:
+                stop += self.query.offset
+            instances = islice(instances, self.query.offset, stop)
+        yield from instances
+
+    def _loaded(self, query, local) -> Iterator[Any]:
+        """Instances of the rows matching the query, except for the ones
+        with unsaved changes."""
+        query_cache = self.model_cls._query_cache
+        key = None if query_cache is None else _cache_key(query)
+        if key is None:
+            return self._read(query, local)
+        ids = query_cache.get(key)
+        if ids is None:
+            return self._read_cached(query_cache, key, query, local)
+        return self._found(ids, local)
+
+    def _read_cached(self, query_cache, key, query, local):
+        """Like _read, keeping the ids found in the query cache once all
+        rows were read."""
+        generation = query_cache.generation
+        ids = []
+        complete = False
+        try:
+            yield from self._read(query, local, ids)
+            complete = True
+        finally:
+            # Stopping after the limit was reached still read all rows
+            if complete or query.limit is not None and len(ids) >= query.limit:
+                names = {name for name, _ in query.order_by}
+                if query.where is not None:
+                    names.update(query.where.names())
+                query_cache.put(key, ids, frozenset(names), generation)
+
+    def _found(self, ids, local) -> Iterator[Any]:
+        """Instances of the ids found by a query before, loading the ones
+        which are no longer cached."""
+        model_cls = self.model_cls
+        instances = model_cls._cache.peek_all(ids)
+        missing = [
+            id_ for id_, instance in zip(ids, instances)
+            if instance is None and id_ not in local
+        ]
+        loaded = {}
+        if missing:
+            query = Query(Column(model_cls, "id").in_(missing))
+            loaded = {
+                instance.id: instance for instance in self._read(query, {})
+            }
+        for id_, instance in zip(ids, instances):
+            if id_ in local:
+                continue
+            if instance is None:
+                instance = loaded.get(id_)
+            if instance is None or instance._has_unsaved_changes:
+                # Deleted, or doesn't match with the values in memory
+                continue
+            yield instance
+
+    def _read(self, query, local, ids=None) -> Iterator[Any]:
+        """Instances of the rows matching the query read from the database,
+        adding the ids of all rows to `ids` if given."""
+        model_cls = self.model_cls
+        cache = model_cls._cache
+        db = model_cls._db
+        decode = db.decoder(model_cls)
+        typed_id = model_cls._typed_id
+        stats = model_cls._stats
+        id_index = tuple(model_cls._meta.fields).index("id")
+        for row in db.select(model_cls, query, self.batch_size):
+            id_ = typed_id(row[id_index])
+            if ids is not None:
+                ids.append(id_)
+            if id_ in local:
+                continue
+            with cache.lock:
+                # Checked and added at once, so a row loaded by several
+                # threads still becomes one instance
+                instance = cache.peek(id_)
+                if instance is None:
+                    instance = decode(row, id_)
+                    stats.hydrations += 1
+            if instance._has_unsaved_changes:
+                # Didn't match with the values in memory
+                continue
+            yield instance
+
+    def __repr__(self):
+        return f"<QuerySet {self.model_cls.__name__} {self.query}>"
+
+    def batch(self, size: int) -> "QuerySet":
+        """Same query set reading `size` rows at a time."""
+        query_set = self._clone()
+        query_set.batch_size = size
+        return query_set
+
+    def prefetch(self, *paths: str) -> "QuerySet":
+        """Same query set also loading the relations named by `paths`."""
+        return self._clone(prefetch_paths=self.prefetch_paths + paths)
+
+    def where(self, condition: Expression) -> "QuerySet":
+        """Narrows the query set down to instances matching a condition."""
+        if self.query.where is not None:
+            condition = And((self.query.where, condition))
+        return self._clone(query=replace(self.query, where=condition))
+
+    def filter(self, **filters) -> "QuerySet":
+        """Narrows the query set down to instances with these values."""
+        return self.where(where(self.model_cls, **filters))
+
+    def order_by(self, *fields) -> "QuerySet":
+        """Same query set sorted by fields, see `Model.find`."""
+        return self._clone(query=replace(
+            self.query, order_by=ordering(self.model_cls, fields)
+        ))
+
+    def limit(self, limit: int) -> "QuerySet":
+        return self._clone(query=replace(self.query, limit=limit))
+
+    def offset(self, offset: int) -> "QuerySet":
+        return self._clone(query=replace(self.query, offset=offset))
+
+    def values(self, *fields) -> Iterator[dict]:
+        """Dicts of the given fields, or all of them, without creating
+        instances. Related instances are represented by their id."""
+        from dcorm.model import _column_value
+
+        model_cls = self.model_cls
+        fields = fields or tuple(model_cls._meta.fields)
+        for name in fields:
+            column(model_cls, name)
+        if model_cls._cache.has_dirty():
+            # Values in memory may differ from the rows
+            for instance in self._instances():
+                values = instance._descriptor_values
+                yield {name: _column_value(values.get(name)) for name in fields}
+            return
+
+        converters = [model_cls._meta.converters[name] for name in fields]
+        query = replace(self.query, columns=fields)
+        for row in model_cls._db.select(model_cls, query, self.batch_size):
+            yield {
+                name: convert(value)
+                for name, convert, value in zip(fields, converters, row)
+            }
+
+    def columns(self, *fields, numpy=None) -> dict:
+        """One sequence per field, or for all of them, with its values
+        in all matching rows, without creating instances.
+
+        Numbers are put into arrays and other values into lists, see
+        `column_chunks`. With `numpy` they are NumPy arrays instead,
+        which is the default if NumPy is installed.
+        """
+        fields, numpy = self._columnar(fields, numpy)
+        return columns.concatenate(
+            self.column_chunks(*fields, numpy=numpy), self.model_cls,
+            fields, numpy
+        )
+
+    def column_chunks(self, *fields, size=None, numpy=None) -> Iterator[dict]:
+        """Like `columns`, for every `size` rows, by default the batch
+        size, so results larger than memory can be processed in parts."""
+        model_cls = self.model_cls
+        fields, numpy = self._columnar(fields, numpy)
+        if model_cls._cache.has_dirty():
+            # Values in memory may differ from the rows, so take them in
+            # the form the mapper stores them
+            columns_ = [Column(model_cls, name) for name in fields]
+            rows = (
+                tuple(column_.value(instance) for column_ in columns_)
+                for instance in self._instances()
+            )
+        else:
+            query = replace(self.query, columns=fields)
+            rows = model_cls._db.select(model_cls, query, self.batch_size)
+        return columns.column_chunks(
+            model_cls, rows, fields, size or self.batch_size, numpy
+        )
+
+    def _columnar(self, fields, numpy) -> tuple:
+        fields = fields or tuple(self.model_cls._meta.fields)
+        for name in fields:
+            column(self.model_cls, name)
+        if numpy is None:
+            numpy = columns.has_numpy()
+        return fields, numpy
+
+    def update(self, **values) -> int:
+        """Sets fields of all matching rows with a single statement and
+        returns how many there were.
+
+        Rows are matched by their values in the database. Cached
+        instances of them get the new values, and move between the
+        collections holding them if relations changed. Unsaved changes
+        to the same fields are still written when saving.
+        """
+        model_cls = self.model_cls
+        meta = model_cls._meta
+        for name in values:
+            column(model_cls, name)
+        if "id" in values:
+            raise ValueError("Ids can't be updated")
+        values = {
+            name: meta.converters[name](value)
+            for name, value in values.items()
+        }
+        db = model_cls._db
+        ids = _bulk(
+            db, db.update_where, model_cls, self.query, values,
+            names=tuple(values),
+        )
+        model_cls._stats.updates += len(ids)
+        session = current_session()
+        for instance in self._cached(ids):
+            if session is not None:
+                session._updated(instance, values)
+            instance._updated(values)
+        _unload_backrefs(model_cls, values)
+        return len(ids)
+
+    def delete(self) -> int:
+        """Deletes all matching rows with a single statement and returns
+        how many there were.
+
+        Rows are matched by their values in the database. Cached
+        instances of them are removed from the cache and from the
+        collections holding them, see `Model.delete`.
+        """
+        from dcorm.model import _held
+
+        model_cls = self.model_cls
+        db = model_cls._db
+        ids = _bulk(db, db.delete_where, model_cls, self.query)
+        model_cls._stats.deletes += len(ids)
+        session = current_session()
+        instances = self._cached(ids)
+        held = _held(model_cls, instances)
+        for instance in instances:
+            changes = instance._changes
+            collections = instance._deleted(held)
+            if session is not None:
+                session._deleted(instance, changes, collections)
+        return len(ids)
+
+    def _cached(self, ids) -> list:
+        """Cached instances of the stored ids."""
+        cache = self.model_cls._cache
+        typed_id = self.model_cls._typed_id
+        instances = (cache.peek(typed_id(id_)) for id_ in ids)
+        return [instance for instance in instances if instance is not None]
+
+    def first(self):
+        """First match or None, loading at most a single row."""
+        query_set = self.batch(1)
+        if self.query.limit is None:
+            query_set = query_set.limit(1)
+        for instance in query_set:
+            return instance
+        return None
+
+    async def afirst(self):
+        return await self.model_cls._db.read(self.first)
+
+    def exists(self) -> bool:
+        return self.first() is not None
+
+    def count(self) -> int:
+        model_cls = self.model_cls
+        if not model_cls._cache.has_dirty():
+            return model_cls._db.count(model_cls, self.query)
+        # Instances in memory may differ from their rows, so count them
+        # the same way they would be iterated
+        return sum(1 for _ in self._instances())
+
+    async def acount(self) -> int:
+        return await self.model_cls._db.read(self.count)
+
+    def explain(self) -> list:
+        """How the database runs the query, see `Mapper.explain`."""
+        return self.model_cls._db.explain(self.model_cls, self.query)
+
+    def _clone(self, **changes) -> "QuerySet":
+        query_set = self.__class__.__new__(self.__class__)
+        query_set.__dict__.update(self.__dict__, **changes)
+        return query_set
+
+
+def _bulk(db, fn, model_cls, *args, names=None):
+    """Runs a bulk write in the current session, or commits it at once.
+    Query results depending on the column names, or all, are dropped."""
+    session = current_session()
+    if session is not None:
+        result = session.execute(db, fn, model_cls, *args)
+        session._invalidate(model_cls, names)
+        return result
+    with Session() as session:
+        result = session.execute(db, fn, model_cls, *args)
+        session._invalidate(model_cls, names)
+    return result
+
+
+def _cache_key(query):
+    """Key of a query in a query cache, or None if it can't be cached."""
+    if query.columns is not None:
+        return None
+    try:
+        key = (
+            None if query.where is None else query.where.key(),
+            query.order_by, query.limit, query.offset,
+        )
+        hash(key)
+    except TypeError:  # Values like lists
+        return None
+    return key
+
+
+def _unload_backrefs(model_cls, values):
+    """Makes collections which rows may have been moved into by an
+    update load again, as only cached instances were added to them."""
+    from dcorm.fields import NOLOAD
+    from dcorm.model import _backrefs
+
+    for name, value in values.items():
+        if name in model_cls._meta.relations:
+            for collection in _backrefs(model_cls, name, value):
+                if collection.loading != NOLOAD:
+                    collection._loaded = False
+
+
+def _prefetch_tree(paths):
+    """Nested dicts of the relation names in dotted paths."""
+    tree = {}
+    for path in paths:
+        node = tree
+        for name in path.split("."):
+            node = node.setdefault(name, {})
+    return tree
+
+
+def _with_eager(model_cls, tree):
+    """The tree plus the relations of the model loaded eagerly."""
+    from dcorm.fields import EAGER
+
+    tree = dict(tree)
+    meta = model_cls._meta
+    for name in meta.relations:
+        if meta.fields[name].loading == EAGER:
+            tree.setdefault(name, {})
+    for name, collection in meta.collections.items():
+        if collection.loading == EAGER:
+            tree.setdefault(name, {})
+    return tree
+
+
+def prefetch(model_cls, instances, tree, _done=None):
+    """Loads the relations in `tree` for all instances, with one query
+    per relation, and recurses into the related instances."""
+    # Relations already handled per instance, so eager relations pointing
+    # back to each other don't recurse forever
+    done = set() if _done is None else _done
+    meta = model_cls._meta
+    for name, subtree in _with_eager(model_cls, tree).items():
+        todo = [
+            instance for instance in instances
+            if (id(instance), name) not in done
+        ]
+        done.update((id(instance), name) for instance in todo)
+        if name in meta.relations:
+            target = meta.relations[name]
+            related = _prefetch_field(target, todo, name)
+        elif name in meta.collections:
+            target = meta.collection_targets[name]
+            related = _prefetch_collection(model_cls, todo, name)
+        else:
+            raise ValueError(
+                f"{model_cls.__name__} has no relation {name!r}"
+            )
+        if related:
+            prefetch(target, related, subtree, done)
+
+
+def _prefetch_field(target, instances, name):
+    from dcorm.model import Model
+
+    missing = set()
+    for instance in instances:
+        value = instance._descriptor_values.get(name)
+        if value is not None and not isinstance(value, Model):
+            if target._cache.peek(value) is None:
+                missing.add(value)
+    if missing:
+        # Hydrating puts them into the identity map
+        query = Query(Column(target, "id").in_(missing))
+        for _ in QuerySet(target, query)._instances():
+            pass
+
+    related = {}
+    for instance in instances:
+        values = instance._descriptor_values
+        value = values.get(name)
+        if value is not None and not isinstance(value, Model):
+            value = target._cache.peek(value)
+            if value is not None:
+                # Not a change, the same id is still stored
+                values[name] = value
+        if value is not None:
+            related[id(value)] = value
+    return list(related.values())
+
+
+def _prefetch_collection(model_cls, instances, name):
+    from dcorm.model import _column_value
+
+    target = model_cls._meta.collection_targets[name]
+    owners = {}
+    for instance in instances:
+        collection = getattr(instance, name)
+        if not collection._loaded and instance._in_db:
+            owners[instance.id] = collection
+        collection._loaded = True
+    if not owners:
+        return []
+    if name in model_cls._meta.join_tables:
+        _load_members(model_cls, name, owners)
+        return _related(owners)
+
+    backref = next(iter(owners.values())).backref
+    if backref not in target._meta.fields:
+        raise ValueError(
+            f"Can't prefetch {name!r}, {target.__name__}.{backref} is not "
+            "a field"
+        )
+    query = Query(Column(target, backref).in_(owners))
+    for relation in QuerySet(target, query)._instances():
+        owner_id = _column_value(relation._descriptor_values.get(backref))
+        owners[owner_id]._add(relation)
+    return _related(owners)
+
+
+def _related(owners) -> list:
+    """The instances in the collections, which were loaded just now."""
+    return [
+        relation
+        for collection in owners.values()
+        for relation in collection.relationships
+    ]
+
+
+def _load_members(model_cls, name, owners):
+    """Adds the instances in the many-to-many collection `name` to the
+    collections in owners, keyed by the id of the instance holding them,
+    with a single join per batch of owners."""
+    target = model_cls._meta.collection_targets[name]
+    model_cls._db.sync()
+    cache = target._cache
+    decode = target._db.decoder(target)
+    typed_id = target._typed_id
+    typed_owner_id = model_cls._typed_id
+    stats = target._stats
+    id_index = tuple(target._meta.fields).index("id")
+    for row in model_cls._db.select_members(model_cls, name, owners):
+        # The fields of the instance, followed by the owner's id
+        id_ = typed_id(row[id_index])
+        with cache.lock:
+            instance = cache.peek(id_)
+            if instance is None:
+                instance = decode(row, id_)
+                stats.hydrations += 1
+        owners[typed_owner_id(row[-1])]._add(instance)
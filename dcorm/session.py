@@ -0,0 +1,327 @@
+from contextvars import ContextVar
+
+from dcorm.storage import NO_CHANGES
+
+
+_current_session = ContextVar("dcorm_session", default=None)
+
+
+def current_session():
+    """The session of the innermost `with Session()` block, if any."""
+    return _current_session.get()
+
+
+class Session:
+    """Unit of work collecting new and changed instances.
+
+    Instances added to the session, and everything reachable through
+    their relations, are written on `flush` with one statement per model
+    and kind of change, all inside a single transaction per mapper.
+
+    Used as a context manager, the session becomes the current one, so
+    `Model.save` only adds to it, and it commits on exit or rolls back
+    if an exception was raised. A flush or commit which fails rolls back
+    as well. `async with` writes with `aflush` instead, and
+    `Model.asave` only adds to the session as well.
+    """
+
+    def __init__(self):
+        self._added = {}
+        # Instances written since the last commit, with their state before
+        self._flushed = []
+        # Cached instances changed by bulk updates and deletes since the
+        # last commit, with their state before
+        self._patched = []
+        # Query caches with the column names changed since the last commit
+        self._invalidations = []
+        self._mappers = {}
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current_session.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _current_session.reset(self._token)
+        self._token = None
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def add(self, instance):
+        """Adds the instance and its relations to be saved on flush."""
+        self._added[id(instance)] = instance
+
+    def add_all(self, instances):
+        for instance in instances:
+            self.add(instance)
+
+    def flush(self):
+        """Writes all pending changes without committing them. If that
+        fails, the session rolls back, see `rollback`."""
+        pending = self._collect()
+        self._added.clear()
+        if not pending:
+            return
+        try:
+            for mapper, by_model in self._by_mapper(pending):
+                self._mappers[id(mapper)] = mapper
+                _write(mapper, by_model)
+                for model_cls, instances in by_model.items():
+                    self._invalidate(model_cls, _written_names(instances))
+        except BaseException:
+            # The instances aren't marked saved yet, so they stay unsaved
+            self.rollback()
+            raise
+        for instance in pending:
+            in_db, changes = instance._in_db, instance._changes
+            collections = _written(instance)
+            self._flushed.append((instance, in_db, changes, collections))
+
+    async def aflush(self):
+        """Writes and commits all pending changes without blocking the
+        event loop.
+
+        Mappers like AsyncSQLite3 queue the writes and commit them
+        together with those of other sessions, so there is nothing to
+        roll back afterwards. Instances shouldn't be changed until this
+        returns.
+        """
+        pending = self._collect()
+        self._added.clear()
+        if not pending:
+            return
+        for mapper, by_model in self._by_mapper(pending):
+            await mapper.write(_write, mapper, by_model)
+            for model_cls, instances in by_model.items():
+                if model_cls._query_cache is not None:
+                    model_cls._query_cache.invalidate(
+                        _written_names(instances)
+                    )
+                for instance in instances:
+                    _written(instance)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        _current_session.reset(self._token)
+        self._token = None
+        if exc_type is None:
+            try:
+                self._commit_flushed()
+                await self.aflush()
+            except BaseException:
+                self.rollback()
+                raise
+        else:
+            self.rollback()
+
+    def execute(self, mapper, fn, *args):
+        """Runs a function writing through the mapper directly, like a
+        bulk update, in the session's transaction after flushing
+        everything pending, so it applies to the saved state."""
+        self.flush()
+        self._mappers[id(mapper)] = mapper
+        return fn(*args)
+
+    def commit(self):
+        """Flushes and commits all pending changes, or rolls back if that
+        fails."""
+        self.flush()
+        try:
+            self._commit_flushed()
+        except BaseException:
+            self.rollback()
+            raise
+
+    def _commit_flushed(self):
+        # Committed mappers are dropped right away, so a failing commit
+        # only rolls back the others
+        for key, mapper in list(self._mappers.items()):
+            mapper.commit()
+            del self._mappers[key]
+        self._flushed.clear()
+        self._patched.clear()
+        self._invalidate_again()
+
+    def rollback(self):
+        """Discards everything flushed since the last commit.
+
+        Instances written in the meantime get their unsaved changes back,
+        so they are written again by the next flush.
+        """
+        mappers = self._mappers
+        for mapper in mappers.values():
+            mapper.rollback()
+        for instance, values, changes, collections in reversed(self._patched):
+            if id(instance._db) not in mappers:
+                # Committed before the commit of another mapper failed
+                continue
+            if values is None:
+                instance._undeleted(changes, collections)
+            else:
+                instance._reverted(values, changes)
+        for instance, was_in_db, changes, collections in self._flushed:
+            if id(instance._db) not in mappers:
+                continue
+            instance._in_db = was_in_db
+            instance._changes = {**instance._changes, **changes}
+            instance._mark_dirty()
+            for name, (inserted, removed) in collections.items():
+                instance._descriptor_values[name]._restore(inserted, removed)
+        self._mappers.clear()
+        self._flushed.clear()
+        self._patched.clear()
+        self._added.clear()
+        self._invalidate_again()
+
+    def _updated(self, instance, values):
+        """Remembers the state of a cached instance before a bulk update
+        in the transaction takes over the values, see `rollback`."""
+        stored = instance._descriptor_values
+        changes = instance._changes
+        self._patched.append((
+            instance,
+            {
+                name: stored.get(name) for name in values
+                if name not in changes
+            },
+            {name: changes[name] for name in values if name in changes},
+            None,
+        ))
+
+    def _deleted(self, instance, changes, collections):
+        """Remembers an instance forgotten because a delete in the
+        transaction removed its row, see `rollback`."""
+        self._patched.append((instance, None, changes, collections))
+
+    def _invalidate(self, model_cls, names=None):
+        """Drops the model's cached query results depending on the column
+        names, or all of them, now and again when the transaction ends,
+        as other threads read what was committed before until then."""
+        query_cache = model_cls._query_cache
+        if query_cache is not None:
+            query_cache.invalidate(names)
+            self._invalidations.append((query_cache, names))
+
+    def _invalidate_again(self):
+        for query_cache, names in self._invalidations:
+            query_cache.invalidate(names)
+        self._invalidations.clear()
+
+    @staticmethod
+    def _by_mapper(instances):
+        """Instances grouped by mapper and model."""
+        by_mapper = {}
+        for instance in instances:
+            mapper = instance._db
+            _, by_model = by_mapper.setdefault(id(mapper), (mapper, {}))
+            by_model.setdefault(instance.__class__, []).append(instance)
+        return by_mapper.values()
+
+    def _collect(self):
+        """Instances with unsaved changes reachable from the added ones."""
+        seen = set()
+        pending = []
+        stack = list(self._added.values())
+        while stack:
+            instance = stack.pop()
+            if id(instance) in seen or not instance.savable:
+                continue
+            seen.add(id(instance))
+            if instance._has_unsaved_changes:
+                pending.append(instance)
+            stack.extend(instance.relations)
+            for name in instance._meta.collections:
+                # Their backrefs changed, but they aren't related anymore
+                stack.extend(getattr(instance, name)._removed.values())
+        return pending
+
+
+def _write(mapper, by_model):
+    """Writes instances with one statement per model and kind of change."""
+    for model_cls in _dependency_order(by_model):
+        instances = by_model[model_cls]
+        new = [inst for inst in instances if not inst._in_db]
+        changed = [inst for inst in instances if inst._in_db]
+        if new:
+            mapper.insert(model_cls, new)
+            model_cls._stats.inserts += len(new)
+        if changed:
+            mapper.update(model_cls, changed)
+            model_cls._stats.updates += len(changed)
+    for model_cls, instances in by_model.items():
+        _write_members(mapper, model_cls, instances)
+
+
+def _write_members(mapper, model_cls, instances):
+    """Writes the instances added to and removed from the many-to-many
+    collections of the instances, for the side owning the join table."""
+    for name, join in model_cls._meta.join_tables.items():
+        if not join.owning:
+            continue
+        added = []
+        removed = []
+        for instance in instances:
+            collection = instance._descriptor_values.get(name)
+            if collection is None:
+                continue
+            added.extend(
+                (instance, member) for member in collection._inserted.values()
+            )
+            removed.extend(
+                (instance, member) for member in collection._removed.values()
+            )
+        if added or removed:
+            mapper.write_members(model_cls, name, added, removed)
+
+
+def _written_names(instances):
+    """Names of the columns the instances changed when writing them, or
+    None if there are new ones, which may change any query result."""
+    names = set()
+    for instance in instances:
+        if not instance._in_db:
+            return None
+        names.update(instance._changes)
+    return names
+
+
+def _written(instance) -> dict:
+    """Marks the instance saved. Returns the instances added to and
+    removed from its collections before, by collection name."""
+    instance._in_db = True
+    instance._changes = NO_CHANGES
+    instance._mark_clean()
+    unsaved = {}
+    values = instance._descriptor_values
+    for name in instance._meta.collections:
+        collection = values.get(name)
+        if collection is not None and (
+            collection._inserted or collection._removed
+        ):
+            unsaved[name] = collection._unsaved()
+    return unsaved
+
+
+def _dependency_order(model_clss):
+    """Orders models so the ones pointed to by relations come first."""
+    ordered = []
+    visiting = set()
+
+    def visit(model_cls):
+        if model_cls in ordered or model_cls in visiting:
+            # Already placed, or a cycle which can't be ordered
+            return
+        visiting.add(model_cls)
+        for target in model_cls._meta.relations.values():
+            if target in model_clss:
+                visit(target)
+        visiting.discard(model_cls)
+        ordered.append(model_cls)
+
+    for model_cls in model_clss:
+        visit(model_cls)
+    return ordered
@@ -0,0 +1,105 @@
+from types import MappingProxyType
+from typing import Any, Iterator, Mapping
+
+
+class _NoChanges(Mapping):
+    """Changes of instances without any, shared until one is tracked."""
+    __slots__ = ()
+
+    def __getitem__(self, name):
+        raise KeyError(name)
+
+    def __iter__(self):
+        return iter(())
+
+    def __len__(self) -> int:
+        return 0
+
+    def __reduce__(self):
+        # Copies and pickles stay the shared instance
+        return "NO_CHANGES"
+
+    def __repr__(self):
+        return "NO_CHANGES"
+
+
+NO_CHANGES = _NoChanges()
+
+
+class FieldValues:
+    """Field values of an instance of a compact model, in slots.
+
+    Behaves like the dict other models keep their values in, but needs
+    no hash table per instance. Each compact model gets a subclass with
+    a slot per field and collection, see `field_values`.
+    """
+    __slots__ = ()
+    # Field name to slot descriptor and the model, set per subclass
+    _members = MappingProxyType({})
+    _model = None
+
+    def get(self, name, default=None):
+        try:
+            return self._members[name].__get__(self)
+        except (KeyError, AttributeError):
+            return default
+
+    def __getitem__(self, name):
+        try:
+            return self._members[name].__get__(self)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def __setitem__(self, name, value):
+        self._members[name].__set__(self, value)
+
+    def __contains__(self, name) -> bool:
+        return self.get(name, _MISSING) is not _MISSING
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def keys(self) -> list:
+        return [name for name, _ in self.items()]
+
+    def items(self) -> list[tuple[str, Any]]:
+        items = []
+        for name in self._members:
+            value = self.get(name, _MISSING)
+            if value is not _MISSING:
+                items.append((name, value))
+        return items
+
+    def __reduce__(self):
+        # The subclass isn't importable, so it is found through the model
+        return _restore, (self._model, dict(self.items()))
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({dict(self.items())})"
+
+
+_MISSING = object()
+
+
+def _restore(model_cls, items) -> FieldValues:
+    values = model_cls._meta.values()
+    for name, value in items.items():
+        values[name] = value
+    return values
+
+
+def field_values(model_cls, names) -> type:
+    """FieldValues subclass with a slot for each of the names."""
+    slots = {name: f"f_{name}" for name in names}
+    cls = type(
+        f"{model_cls.__name__}Values", (FieldValues,),
+        {"__slots__": tuple(slots.values()), "__module__": __name__},
+    )
+    cls._members = MappingProxyType({
+        name: getattr(cls, slot) for name, slot in slots.items()
+    })
+    cls._model = model_cls
+    return cls
@@ -0,0 +1,36 @@
+import copy
+import os
+import pickle
+
+from dcorm import Field, register, Model
+from dcorm.mappers.sqlite import SQLite3
+
+
+# Create and connect to database
+db_name = "db.sqlite"
+try:
+    os.remove(db_name)
+except FileNotFoundError:
+    pass
+db = SQLite3(db_name)
+
+
+# Create Models
+@register(db=db, slots=True)
+class Log(Model):
+    id: int = Field()
+    message: str = Field()
+
+
+log = Log(id=1, message="Started")
+log.save()
+assert not hasattr(log, "__dict__")
+
+# Compact instances are pickled and copied like other instances
+log.message = "Stopped"
+for restored in (pickle.loads(pickle.dumps(log)), copy.deepcopy(log)):
+    assert restored == log and restored is not log
+    assert restored.message == "Stopped"
+
+log.save()
+assert Log.get(id=1).message == "Stopped"
@@ -51,9 +51,9 @@ user.save()
 # class_.save()
 
 
-# ToDo: get multiple objects from DB
-# User.find(name="Bob")
-# User.find(name="Bob", limit=10)
+# Get multiple objects from DB
+print(list(User.find(name="Bob")))
+print(list(User.find(User.name.startswith("B"), order_by="-name", limit=10)))
 
 
 # Get one object from DB
@@ -70,7 +70,12 @@ assert class_ is class_2
 # User.pre_load()
 
 
-# ToDo: deleting entries
+# Change or delete many entries at once, without loading them
+User.find(User.name.startswith("B")).update(rank=Rank.SECOND)
+User.find(class_=None).delete()
 
 
-# ToDo: support lambda function in get/find
+# Delete a single entry
+user.delete()
+assert User.get(name="Bob") is None
+
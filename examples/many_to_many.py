@@ -47,11 +47,19 @@ pet1.save()
 pet2.save()
 
 
-# # Get one object from DB
-# user2 = User.get(name="Bob")
-# class_2 = Class.get(name="1st Class")
-#
-#
-# # When model is loaded from DB, it's cached
-# assert user is user2
-# assert class_ is class_2
+# Load from the database, the pets of each human with a single join
+Human._cache.clear()
+Pet._cache.clear()
+owner1 = Human.get(name="Bob")
+assert sorted(pet.name for pet in owner1.pets) == ["Caty", "Doggo"]
+doggo = Pet.get(name="Doggo")
+assert doggo in owner1.pets
+assert sorted(human.name for human in doggo.humans) == ["Bertha", "Bob"]
+
+
+# Only the removed pair is deleted from the join table
+owner1.pets.remove(doggo)
+owner1.save()
+Human._cache.clear()
+Pet._cache.clear()
+assert [pet.name for pet in Human.get(name="Bob").pets] == ["Caty"]
@@ -0,0 +1,34 @@
+import os
+
+from dcorm import Field, register, Model
+from dcorm.mappers.sqlite import SQLite3
+
+
+# Create and connect to database
+db_name = "db.sqlite"
+try:
+    os.remove(db_name)
+except FileNotFoundError:
+    pass
+db = SQLite3(db_name)
+
+
+# Create Models
+@register(db=db)
+class User(Model):
+    id: int = Field()
+    name: str = Field()
+
+
+for id_ in (1, 2, 3):
+    User(id=id_, name="Bob").save()
+
+
+# Paging a query choosing ids
+page = User.find(User.id.in_([1, 2, 3]), order_by="id", offset=1, limit=1)
+assert [user.id for user in page] == [2]
+assert page.count() == 1
+
+# Deleting a page only deletes its rows
+User.find(User.id.in_([1, 2, 3]), order_by="id", offset=2, limit=1).delete()
+assert [user.id for user in User.all().order_by("id")] == [1, 2]
@@ -17,5 +17,5 @@ setuptools.setup(
         "Bug Tracker": "https://github.com/pyfection/DCORM/issues"
     },
     license="MIT",
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_packages(exclude=["benchmarks*"]),
 )